@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the keepitfresh update pipeline.
+
+Serves synthetic release pages and archives from a local HTTP server, with
+optional latency and bandwidth limits, and times ``get_file_urls``,
+``get_update_version``, ``dl_unpack`` and the Unix path of
+``overwrite_restart`` (with the restart stubbed out). Results are written
+as JSON so runs from different commits can be compared::
+
+    $ python benchmarks/bench_keepitfresh.py --output before.json
+    $ git checkout other-branch
+    $ python benchmarks/bench_keepitfresh.py --compare before.json
+
+Every benchmark is repeated ``--repeat`` times and reports the minimum,
+median and mean wall time in seconds.
+"""
+
+import argparse
+import http.server
+import io
+import json
+import os
+import platform
+import socketserver
+import statistics
+import subprocess
+import sys
+import tarfile
+import time
+import zipfile
+from shutil import copytree, rmtree
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import keepitfresh  # noqa: E402 pylint: disable=wrong-import-position
+
+REGEX = r'example-(\d+\.\d+\.\d+)\.zip'
+
+
+class BenchServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Serves ``files`` by path, waiting ``latency`` seconds before answering
+    and sending at most ``bandwidth`` bytes per second if set.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, BenchHandler)
+        self.files = {}
+        self.latency = 0
+        self.bandwidth = None
+
+
+class BenchHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        data = server.files.get(self.path)
+        if server.latency:
+            time.sleep(server.latency)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+        step = len(data) or 1
+        if server.bandwidth:
+            step = max(server.bandwidth // 20, 1)
+        for offset in range(0, len(data), step):
+            self.wfile.write(data[offset:offset + step])
+            if server.bandwidth:
+                time.sleep(step / server.bandwidth)
+
+    def log_message(self, *args):
+        pass
+
+
+def release_page(links):
+    """
+    Returns a release page with **links** archive links, newest first.
+    """
+    rows = ['<html><body><ul>']
+    for index in range(links, 0, -1):
+        version = '{}.{}.{}'.format(index // 10000, index // 100 % 100,
+                                    index % 100)
+        rows.append('<li><a href="/download/{0}/example-{0}.zip" '
+                    'rel="nofollow">example-{0}.zip</a> '
+                    '<a href="/notes/{0}">notes</a></li>'.format(version))
+    rows.append('</ul></body></html>')
+    return '\n'.join(rows).encode('utf8')
+
+
+def archive(fmt, files, size):
+    """
+    Returns a **fmt** (``'zip'`` or ``'tar.gz'``) archive holding **files**
+    files of random data adding up to **size** bytes.
+    """
+    member_size = size // files
+    buffer = io.BytesIO()
+    if fmt == 'zip':
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for index in range(files):
+                zipf.writestr('app/{}/{}.bin'.format(index % 10, index),
+                              os.urandom(member_size))
+    else:
+        with tarfile.open(fileobj=buffer, mode='w:gz') as tarf:
+            for index in range(files):
+                info = tarfile.TarInfo('app/{}/{}.bin'.format(index % 10,
+                                                              index))
+                info.size = member_size
+                tarf.addfile(info, io.BytesIO(os.urandom(member_size)))
+    return buffer.getvalue()
+
+
+def make_tree(root, files, size):
+    """
+    Writes **files** files adding up to **size** bytes below **root**.
+    """
+    for index in range(files):
+        path = os.path.join(root, str(index % 10), '{}.bin'.format(index))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as out_file:
+            out_file.write(os.urandom(size // files))
+    with open(os.path.join(root, 'run'), 'w') as run_file:
+        run_file.write('#!/bin/sh\n')
+
+
+def timeit(func, repeat, setup=None):
+    """
+    Runs **func** **repeat** times, after **setup** if passed, and returns
+    the wall times.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_get_file_urls(server, base_url, sizes, repeat):
+    for links in sizes['links']:
+        server.files['/releases'] = release_page(links)
+        for latency in sizes['latency']:
+            server.latency = latency
+            yield ({'links': links, 'latency': latency,
+                    'bytes': len(server.files['/releases'])},
+                   timeit(lambda: keepitfresh.get_file_urls(
+                       base_url + '/releases', REGEX), repeat))
+    server.latency = 0
+
+
+def bench_get_update_version(sizes, repeat):
+    for links in sizes['links']:
+        file_dict = {
+            'https://example.com/example-{0}.{1}.{2}.zip'.format(
+                index // 10000, index // 100 % 100, index % 100):
+            '{}.{}.{}'.format(index // 10000, index // 100 % 100, index % 100)
+            for index in range(links)}
+
+        def run():
+            keepitfresh._parse_version.cache_clear()
+            keepitfresh.get_update_version(file_dict, '0.0.1')
+        yield {'links': links}, timeit(run, repeat)
+
+
+def bench_dl_unpack(server, base_url, sizes, repeat):
+    for fmt in ('zip', 'tar.gz'):
+        for files, size in sizes['archives']:
+            path = '/example-1.0.0.' + fmt
+            server.files[path] = archive(fmt, files, size)
+            for bandwidth in sizes['bandwidth']:
+                server.bandwidth = bandwidth
+                for stream in (False, True):
+                    def run():
+                        with TemporaryDirectory() as outdir:
+                            keepitfresh.dl_unpack(base_url + path, outdir,
+                                                  stream=stream)
+                    yield ({'format': fmt, 'files': files, 'size': size,
+                            'bandwidth': bandwidth, 'stream': stream},
+                           timeit(run, repeat))
+            del server.files[path]
+    server.bandwidth = None
+
+
+def bench_overwrite_restart(sizes, repeat):
+    for files, size in sizes['trees']:
+        for mode in ('copy', 'swap', 'incremental'):
+            with TemporaryDirectory() as tmpdir:
+                owitem = os.path.join(tmpdir, 'app', 'example')
+                initem = os.path.join(tmpdir, 'new', 'example')
+                make_tree(owitem, files, size)
+                make_tree(initem, files, size)
+                template = os.path.join(tmpdir, 'template')
+                copytree(initem, template)
+                old_template = os.path.join(tmpdir, 'old_template')
+                copytree(owitem, old_template)
+
+                def setup():
+                    # Every repeat replaces the old tree, not the one left
+                    # by the previous repeat, and without its manifest.
+                    rmtree(os.path.dirname(owitem))
+                    copytree(old_template, owitem)
+                    if not os.path.exists(initem):
+                        copytree(template, initem)
+
+                def run():
+                    with mock.patch('keepitfresh.os.execl'):
+                        keepitfresh.overwrite_restart(
+                            initem, owitem, 'example/run', mode=mode)
+                yield ({'files': files, 'size': size, 'mode': mode},
+                       timeit(run, repeat, setup))
+
+
+def summarize(name, params, times):
+    return {
+        'name': name,
+        'params': params,
+        'times': times,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times)}
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'timestamp': time.time()}
+
+
+def compare(results, baseline):
+    """
+    Prints the ratio of each median time to the one in **baseline**.
+    """
+    def key(result):
+        return result['name'], json.dumps(result['params'], sort_keys=True)
+
+    previous = {key(result): result for result in baseline['results']}
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        print('{:>7.2f}x  {} {}'.format(
+            result['median'] / old['median'], result['name'],
+            json.dumps(result['params'], sort_keys=True)), file=sys.stderr)
+
+
+SIZES = {
+    'full': {
+        'links': [10, 1000, 10000, 100000],
+        'latency': [0, 0.05],
+        'archives': [(10, 1024 * 1024), (1000, 16 * 1024 * 1024),
+                     (10, 64 * 1024 * 1024)],
+        'bandwidth': [None, 32 * 1024 * 1024],
+        'trees': [(100, 1024 * 1024), (2000, 64 * 1024 * 1024)]},
+    'quick': {
+        'links': [10, 1000],
+        'latency': [0],
+        'archives': [(10, 1024 * 1024)],
+        'bandwidth': [None],
+        'trees': [(100, 1024 * 1024)]},
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--quick', action='store_true',
+                        help="run smaller benchmarks")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append',
+                        choices=['get_file_urls', 'get_update_version',
+                                 'dl_unpack', 'overwrite_restart'],
+                        help="only run these benchmarks")
+    parser.add_argument('--output', help="write the results to this file")
+    parser.add_argument('--compare', help="results file to compare with")
+    args = parser.parse_args(argv)
+    sizes = SIZES['quick' if args.quick else 'full']
+
+    server = BenchServer(('localhost', 0))
+    Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://localhost:{}'.format(server.server_address[1])
+
+    benches = [
+        ('get_file_urls',
+         lambda: bench_get_file_urls(server, base_url, sizes, args.repeat)),
+        ('get_update_version',
+         lambda: bench_get_update_version(sizes, args.repeat)),
+        ('dl_unpack',
+         lambda: bench_dl_unpack(server, base_url, sizes, args.repeat)),
+        ('overwrite_restart',
+         lambda: bench_overwrite_restart(sizes, args.repeat))]
+    if os.name == 'nt':
+        benches.pop()
+
+    results = []
+    try:
+        for name, bench in benches:
+            if args.only and name not in args.only:
+                continue
+            for params, times in bench():
+                results.append(summarize(name, params, times))
+                print('{:>9.4f}s  {} {}'.format(
+                    results[-1]['median'], name,
+                    json.dumps(params, sort_keys=True)), file=sys.stderr)
+    finally:
+        server.shutdown()
+
+    report = {'meta': metadata(), 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as out_file:
+            json.dump(report, out_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf8') as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == '__main__':
+    main()
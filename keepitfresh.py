@@ -18,195 +18,3497 @@
 The main bulk of the library.
 """
 
+import codecs
+import errno
+import hashlib
+import importlib
+import json
 import os
+import queue
+import random
+import re
 import stat
-import subprocess
-from platform import system
-from re import findall
-from shutil import copy2, copyfileobj, copytree, rmtree
-from tempfile import TemporaryDirectory
-from urllib.parse import urljoin
-from urllib.request import urlopen
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from functools import cmp_to_key, lru_cache, partial
+from heapq import heappop, heappush, nlargest
+from io import BytesIO
+from urllib.parse import urljoin, urlsplit
 
-from packaging.version import parse
-from patoolib import extract_archive
+try:
+    import fcntl
+    msvcrt = None  # pylint: disable=invalid-name
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
+# Heavier modules, such as packaging, patoolib, asyncio or http.client, are
+# imported by the functions that need them so that importing keepitfresh,
+# and checking for updates from a PageCache, stays cheap.
+# pylint: disable=import-outside-toplevel
 
-def get_file_urls(base_url, regex):
+
+_ANCHOR_RE = re.compile(r'<\s*a\s[^>]*>', re.IGNORECASE)
+_HREF_RE = re.compile(r'\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\')',
+                      re.IGNORECASE)
+_REL_RE = re.compile(r'\brel\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))',
+                     re.IGNORECASE)
+_LINK_RE = re.compile(r'<([^>]*)>[^,]*?\brel\s*=\s*"?([^",;]*)',
+                      re.IGNORECASE)
+_META_CHARSET_RE = re.compile(
+    br'<meta\s[^>]*?charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+_CHUNK_SIZE = 64 * 1024
+_MAX_TAG_SIZE = 64 * 1024
+_SNIFF_SIZE = 1024
+_MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+_STATE_SUFFIX = '.keepitfresh.json'
+_SPOOL_SIZE = 32 * 1024 * 1024
+_PREALLOCATE_SIZE = 1024 * 1024
+_DELTA_INFO = '.keepitfresh-delta.json'
+_DELTA_SUFFIX = '.bsdiff'
+_STAGED_READY = 'ready.json'
+_STAGED_UPDATE = 'update'
+_STORE_STATE = '.keepitfresh-store.json'
+_STORE_CURRENT = 'current'
+_STORE_VERSIONS = 'versions'
+_LISTEN_FDS_START = 3
+_LINK_PREFIX = 'link:'
+_CHECKSUM_RE = re.compile(
+    r'(?P<digest>[0-9a-fA-F]{32,})\s+\*?(?P<name>.+?)\s*$')
+_BSD_CHECKSUM_RE = re.compile(
+    r'\w+\s*\((?P<name>.+)\)\s*=\s*(?P<digest>[0-9a-fA-F]{32,})\s*$')
+_ARCHIVE_FORMATS = (
+    (('.tar',), 'r|'),
+    (('.tar.gz', '.tgz'), 'r|gz'),
+    (('.tar.bz2', '.tbz2', '.tbz'), 'r|bz2'),
+    (('.tar.xz', '.txz'), 'r|xz'),
+    (('.zip',), 'zip'))
+
+
+class IntegrityError(Exception):
+    """
+    Raised when a downloaded archive does not match its expected checksum or
+    fails signature verification.
+    """
+
+
+class TraceCollector:
+    """
+    A tracer that collects the timing events of an update to report them
+    later, for example::
+
+        >>> tracer = TraceCollector()
+        >>> is_fresh(base_url, regex, current_version, tracer=tracer)
+        >>> tracer.dump("trace.json")
+
+    A tracer is any function that takes a single event dictionary, with the
+    ``phase`` name, its ``start`` and ``end`` timestamps (as in
+    :func:`time.time`) and ``duration`` in seconds, an ``error`` name if it
+    failed and, depending on the phase, the ``url`` involved, the ``bytes``
+    transferred and their ``throughput`` in bytes per second, or the number
+    of ``files`` found. The phases are:
+
+    - ``'fetch_index'`` - a release page is downloaded and scanned, or
+      revalidated when ``not_modified`` is ``True``, or taken from the cache
+      without asking the server when ``cached`` is ``True``.
+    - ``'scan'`` - the time spent scanning that page, which happens while it
+      is downloaded, and the number of matching ``files``.
+    - ``'rank'`` - the candidate ``files`` are compared for the latest.
+    - ``'download'`` - an archive is downloaded (or unpacked while being
+      downloaded if ``streamed`` is ``True``).
+    - ``'delta'`` - the deltas of an update are downloaded and applied.
+    - ``'unpack'`` - an archive is unpacked into ``files`` files.
+    - ``'overwrite'`` - the application is replaced, before restarting.
+    - ``'install'`` - the update is installed into a :class:`VersionStore`
+      and activated as its ``version``, before restarting.
+
+    Events may be reported from several threads.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def to_json(self, **kwargs):
+        """
+        Returns the collected events as a JSON array, passing **kwargs** to
+        :func:`json.dumps`.
+        """
+        with self._lock:
+            return json.dumps(self.events, **kwargs)
+
+    def dump(self, path):
+        """
+        Writes the collected events as a JSON array to **path**.
+        """
+        with open(path, 'w', encoding='utf8') as trace_file:
+            trace_file.write(self.to_json())
+
+
+class _Span:
+    """
+    Times a **phase** for **tracer**, see
+    :class:`~keepitfresh.TraceCollector`, reporting it with the extra
+    **info** on :meth:`finish` or when its ``with`` block exits.
+    """
+
+    def __init__(self, tracer, phase, **info):
+        self.tracer = tracer
+        self.info = info
+        self.info['phase'] = phase
+        self._start = time.time()
+        self._clock = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.info['error'] = exc_type.__name__
+        self.finish()
+
+    def finish(self, duration=None, **info):
+        """
+        Reports the phase, once, as lasting **duration** seconds or until
+        now, with the extra **info**.
+        """
+        tracer, self.tracer = self.tracer, None
+        if tracer is None:
+            return
+        event = dict(self.info, **info)
+        if duration is None:
+            duration = time.perf_counter() - self._clock
+        event['start'] = self._start
+        event['end'] = self._start + duration
+        event['duration'] = duration
+        if event.get('bytes') is not None and duration > 0:
+            event['throughput'] = event['bytes'] / duration
+        tracer(event)
+
+
+def _count_files(path):
+    """
+    Counts the files in the **path** folder and its subfolders.
+    """
+    return sum(len(filenames) for _, _, filenames in os.walk(path))
+
+
+class PageCache:
+    """
+    A persistent cache for the release pages fetched by
+    :func:`~keepitfresh.get_file_urls`.
+
+    Each entry stores the page's ``ETag``/``Last-Modified`` headers along with
+    the already parsed ``{file_url: file_version}`` dictionary. Later checks
+    send a conditional request and, whenever the server answers with
+    ``304 Not Modified``, skip both the body transfer and the regex scan.
+
+    **cache_dir** is the folder where entries are stored and is created if
+    needed. Entries that have not been validated for more than **ttl**
+    seconds are discarded. Whenever the stored entries take up more than
+    **max_size** bytes, the least recently used ones are evicted.
+
+    Entries validated less than **max_age** seconds ago are used as they
+    are, without asking the server at all, so an application that checks
+    on every launch only goes to the network once every **max_age**
+    seconds.
+    """
+
+    def __init__(self, cache_dir, ttl=7 * 24 * 60 * 60,
+                 max_size=10 * 1024 * 1024, max_age=0):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def _path(self, url):
+        digest = hashlib.sha256(url.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + '.json')
+
+    def get(self, url):
+        """
+        Returns the entry stored for **url** or ``None`` if there is no
+        entry or it has expired.
+        """
+        path = self._path(url)
+        try:
+            with open(path, 'r', encoding='utf8') as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get('url') != url:
+            return None
+        if time.time() - entry.get('stored', 0) > self.ttl:
+            self._remove(path)
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, url, entry):
+        """
+        Stores **entry** for **url**, stamping it with the current time, and
+        evicts old entries if the cache grew too large.
+        """
+        entry = dict(entry, url=url, stored=time.time())
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(url)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf8') as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        for path in self._entries():
+            self._remove(path)
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return []
+        return [os.path.join(self.cache_dir, name)
+                for name in names if name.endswith('.json')]
+
+    def _evict(self):
+        entries = []
+        for path in self._entries():
+            try:
+                entry_st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((entry_st.st_mtime, entry_st.st_size, path))
+
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self._remove(path)
+            total_size -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class Session:
+    """
+    An HTTP client to share between calls, so that requests to the same host
+    reuse connections instead of paying for a new TCP (and TLS) handshake
+    each time::
+
+        >>> with Session(timeout=10) as session:
+        ...     freshen_up(..., session=session)
+
+    Every function that touches the network takes a **session** argument.
+    Without one, each request opens its own connection with
+    :func:`urllib.request.urlopen`.
+
+    Up to **max_idle** idle keep-alive connections are kept per host and
+    host names are resolved at most once every **dns_ttl** seconds.
+    **timeout** is the number of seconds to wait to connect and for each
+    read. HTTPS connections use the :class:`ssl.SSLContext` in **context**,
+    the default one if not passed.
+
+    Requests that would go through a proxy configured in the environment
+    and urls other than ``http://`` and ``https://`` ones are handed to
+    :func:`urllib.request.urlopen`. A session can be used from several
+    threads at once.
+    """
+
+    def __init__(self, timeout=30, max_idle=4, dns_ttl=5 * 60, context=None):
+        import ssl
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.dns_ttl = dns_ttl
+        self.context = context or ssl.create_default_context()
+        self._idle = {}
+        self._addresses = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes every idle connection.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def open(self, url, headers=None, method=None, redirects=10):
+        """
+        Sends a **method** (``GET`` by default) request for **url** with the
+        extra **headers**, following up to **redirects** redirects, and
+        returns the response. Like :func:`urllib.request.urlopen`, raises
+        :class:`urllib.error.HTTPError` for error statuses, but returns
+        ``304 Not Modified`` answers.
+        """
+        from urllib.error import HTTPError
+        from urllib.request import Request, getproxies, proxy_bypass, urlopen
+        parts = urlsplit(url)
+        proxies = getproxies()
+        if parts.scheme not in ('http', 'https') or (
+                parts.scheme in proxies and not proxy_bypass(parts.hostname)):
+            request = Request(url, headers=headers or {}, method=method)
+            try:
+                return urlopen(request, timeout=self.timeout)
+            except HTTPError as exc:
+                if exc.code == 304:
+                    return exc
+                raise
+
+        method = method or 'GET'
+        key = (parts.scheme, parts.hostname,
+               parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = {'Host': _host_header(parts),
+                           'User-Agent': 'keepitfresh',
+                           'Accept-Encoding': 'identity'}
+        request_headers.update(headers or {})
+
+        response = self._request(key, method, path, request_headers, url)
+        status = response.getcode()
+        location = response.headers.get('Location')
+        if status in (301, 302, 303, 307, 308) and location and redirects:
+            response.read()
+            response.close()
+            if status == 303 or (status in (301, 302) and method == 'POST'):
+                method = 'GET'
+            return self.open(urljoin(url, location), headers, method,
+                             redirects - 1)
+        if status >= 400:
+            raise HTTPError(url, status, response.reason, response.headers,
+                            response)
+        return response
+
+    def _request(self, key, method, path, headers, url):
+        """
+        Sends the request over an idle connection to **key** if there is
+        one that is still open, or over a new one.
+        """
+        from http.client import HTTPException
+        while True:
+            connection = self._checkout(key)
+            reused = connection is not None
+            if not reused:
+                connection = self._connect(key)
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+            except (ConnectionError, HTTPException):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            return _SessionResponse(self, key, connection, response, url,
+                                    method)
+
+    def _checkout(self, key):
+        with self._lock:
+            connections = self._idle.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def _connect(self, key):
+        scheme, host, port = key
+        http_class, https_class = _session_connections()
+        if scheme == 'https':
+            return https_class(self, host, port)
+        return http_class(self, host, port)
+
+    def _create_connection(self, host, port):
+        """
+        Opens a socket to **host**, trying each of its cached addresses.
+        """
+        import socket
+        now = time.monotonic()
+        with self._lock:
+            expires, addresses = self._addresses.get((host, port), (0, None))
+        if addresses is None or now > expires:
+            addresses = socket.getaddrinfo(host, port, 0,
+                                           socket.SOCK_STREAM)
+            with self._lock:
+                self._addresses[host, port] = (now + self.dns_ttl, addresses)
+
+        error = None
+        for family, sock_type, proto, _, address in addresses:
+            sock = socket.socket(family, sock_type, proto)
+            try:
+                sock.settimeout(self.timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.connect(address)
+                return sock
+            except OSError as exc:
+                sock.close()
+                error = exc
+        raise error
+
+
+def _host_header(parts):
+    """
+    Returns the ``Host`` header value for the split url **parts**: its host
+    and, if not the default one, its port, leaving out any user info.
+    """
+    host = parts.hostname
+    if ':' in host:
+        host = '[{}]'.format(host)
+    if parts.port is not None and parts.port != (
+            443 if parts.scheme == 'https' else 80):
+        host += ':{}'.format(parts.port)
+    return host
+
+
+@lru_cache(maxsize=None)
+def _session_connections():
+    """
+    Returns the :class:`http.client.HTTPConnection` and
+    :class:`http.client.HTTPSConnection` subclasses that connect through
+    their :class:`~keepitfresh.Session`, defined on first use so that
+    :mod:`http.client` is only imported when needed.
+    """
+    from http.client import HTTPConnection, HTTPSConnection
+
+    class SessionHTTPConnection(HTTPConnection):
+        """
+        An :class:`http.client.HTTPConnection` that connects through its
+        :class:`~keepitfresh.Session`.
+        """
+
+        def __init__(self, session, host, port):
+            super().__init__(host, port, timeout=session.timeout)
+            self._session = session
+
+        def connect(self):
+            """
+            Connects to the host with the session's cached addresses.
+            """
+            self.sock = self._session._create_connection(self.host,
+                                                         self.port)
+
+    class SessionHTTPSConnection(HTTPSConnection):
+        """
+        An :class:`http.client.HTTPSConnection` that connects through its
+        :class:`~keepitfresh.Session`.
+        """
+
+        def __init__(self, session, host, port):
+            super().__init__(host, port, timeout=session.timeout,
+                             context=session.context)
+            self._session = session
+
+        def connect(self):
+            """
+            Connects to the host with the session's cached addresses and
+            starts TLS with the session's context.
+            """
+            sock = self._session._create_connection(self.host, self.port)
+            self.sock = self._session.context.wrap_socket(
+                sock, server_hostname=self.host)
+
+    return SessionHTTPConnection, SessionHTTPSConnection
+
+
+class _SessionResponse:
+    """
+    A response read from a :class:`~keepitfresh.Session` connection, which
+    goes back to the session's pool once the body was read and closed.
+    """
+    # Mirrors the state of http.client.HTTPResponse it wraps.
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, session, key, connection, response, url, method):
+        self._session = session
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+        if method == 'HEAD' or response.length == 0:
+            response.read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def getcode(self):
+        """
+        Returns the HTTP status code.
+        """
+        return self.status
+
+    def geturl(self):
+        """
+        Returns the url that was requested, after redirects.
+        """
+        return self.url
+
+    def info(self):
+        """
+        Returns the response headers.
+        """
+        return self.headers
+
+    def read(self, size=-1):
+        """
+        Reads up to **size** bytes of the body, or all of it by default.
+        """
+        if size is None or size < 0:
+            return self._response.read()
+        return self._response.read(size)
+
+    def close(self):
+        """
+        Returns the connection to the session's pool if the whole body was
+        read and the server keeps it alive, or closes it otherwise.
+        """
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        response = self._response
+        if response.isclosed() and not response.will_close:
+            self._session._checkin(self._key, connection)
+        else:
+            response.close()
+            connection.close()
+
+
+class MirrorScores:
+    """
+    A table of how fast each mirror has been, used to pick mirrors in
+    :func:`~keepitfresh.race_mirrors` and :func:`~keepitfresh.dl_unpack`.
+
+    Mirrors are identified by their ``scheme://host[:port]`` origin and
+    scored by a moving average, weighted by **alpha**, of their latency and
+    download throughput. A failure ranks a mirror after all the others
+    until it succeeds again. If a **path** is passed, the table is loaded
+    from and saved to it after every update.
+    """
+
+    def __init__(self, path=None, alpha=0.3):
+        self.path = path
+        self.alpha = alpha
+        self.scores = (_read_state(path) if path else None) or {}
+        self._lock = threading.Lock()
+
+    def record(self, url, latency=None, throughput=None, failed=False):
+        """
+        Records how the mirror of **url** performed: the **latency**, in
+        seconds, until it answered, its **throughput**, in bytes per second,
+        or that it **failed**.
+        """
+        origin = _origin(url)
+        with self._lock:
+            score = self.scores.setdefault(origin, {})
+            if failed:
+                score['failures'] = score.get('failures', 0) + 1
+            else:
+                score['failures'] = 0
+            for name, value in (('latency', latency),
+                                ('throughput', throughput)):
+                if value is not None:
+                    old = score.get(name)
+                    score[name] = value if old is None else (
+                        self.alpha * value + (1 - self.alpha) * old)
+            if self.path:
+                _write_state(self.path, self.scores)
+
+    def rank(self, urls, metric='latency'):
+        """
+        Returns **urls** sorted from the best mirror to the worst one, by
+        their **metric**, ``'latency'`` or ``'throughput'``. Mirrors without a
+        score go after the ones that are known to work, and mirrors that
+        failed last go after every other one.
+        """
+        def key(url):
+            score = self.scores.get(_origin(url), {})
+            value = score.get(metric)
+            if value is None:
+                return (score.get('failures', 0), 1, 0)
+            return (score.get('failures', 0), 0,
+                    -value if metric == 'throughput' else value)
+
+        with self._lock:
+            return sorted(urls, key=key)
+
+
+def _origin(url):
+    """
+    Returns the ``scheme://host[:port]`` origin of **url**.
+    """
+    parts = urlsplit(url)
+    return '{}://{}'.format(parts.scheme, parts.netloc)
+
+
+def _urlopen(url, headers=None, method=None, session=None):
+    """
+    Opens **url** with the extra request **headers**, through **session**
+    if passed.
+
+    A ``304 Not Modified`` answer is returned as a regular response instead
+    of raising.
+    """
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+    if session is not None:
+        return session.open(url, headers, method)
+    request = Request(url, headers=headers or {}, method=method)
+    try:
+        return urlopen(request)
+    except HTTPError as exc:
+        if exc.code == 304:
+            return exc
+        raise
+
+
+@lru_cache(maxsize=64)
+def _compile_file_regex(regex):
+    """
+    Compiles the user **regex** so that it matches the end of a whole href.
+    """
+    return re.compile(r'.*?(?:' + regex + r')\Z')
+
+
+class _AnchorScanner:
+    """
+    Incrementally extracts the ``(href, rel)`` attributes of every
+    ``<a href="*">`` out of a binary stream fed in chunks, with **rel** being
+    an empty string when missing.
+
+    Only an unfinished tag at the end of a chunk is carried over to the next
+    one so memory use does not depend on the size of the page.
+
+    The stream is decoded as **charset** or, when it is ``None`` or unknown,
+    as declared by a byte order mark or a ``<meta charset>`` tag at the start
+    of the stream, falling back on UTF-8. Undecodable bytes are replaced.
+    """
+    # A feed-only parser, like html.parser's.
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, charset):
+        self._charset = charset
+        self._decoder = None
+        self._head = b''
+        self._tail = ''
+
+    def feed(self, chunk, final=False):
+        """
+        Scans the next **chunk** of bytes and returns the anchors found.
+        Pass ``final=True`` with the last chunk, even if empty.
+        """
+        from html import unescape
+        if self._decoder is None:
+            # The charset is only chosen once enough of the stream has
+            # arrived to find its byte order mark or <meta charset>.
+            self._head += chunk
+            if len(self._head) < _SNIFF_SIZE and not final:
+                return []
+            self._decoder = _incremental_decoder(self._charset, self._head)
+            chunk, self._head = self._head, b''
+        text = self._tail + self._decoder.decode(chunk, final=final)
+
+        anchors = []
+        end = 0
+        for match in _ANCHOR_RE.finditer(text):
+            tag = match.group()
+            href = _HREF_RE.search(tag)
+            if href is not None:
+                rel = None
+                if 'next' in tag.lower():
+                    rel = _REL_RE.search(tag)
+                if rel is not None:
+                    rel = rel.group(1) or rel.group(2) or rel.group(3)
+                anchors.append((unescape(href.group(1) or href.group(2) or
+                                         ''), rel or ''))
+            end = match.end()
+
+        start = text.rfind('<', end)
+        if final or start == -1 or len(text) - start > _MAX_TAG_SIZE:
+            self._tail = ''
+        else:
+            self._tail = text[start:]
+        return anchors
+
+
+def _incremental_decoder(charset, head):
+    """
+    Returns an incremental decoder for **charset**, or the one declared in
+    **head**, the start of an HTML document, see :class:`_AnchorScanner`.
+    """
+    for bom, name in ((codecs.BOM_UTF8, 'utf-8-sig'),
+                      (codecs.BOM_UTF16_LE, 'utf-16'),
+                      (codecs.BOM_UTF16_BE, 'utf-16')):
+        if head.startswith(bom):
+            return codecs.getincrementaldecoder(name)(errors='replace')
+    if charset is None:
+        match = _META_CHARSET_RE.search(head[:_SNIFF_SIZE])
+        if match is not None:
+            charset = match.group(1).decode('ascii')
+    try:
+        return codecs.getincrementaldecoder(charset or 'utf-8')(
+            errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+
+@lru_cache(maxsize=None)
+def _brotli():
+    """
+    Returns the :mod:`brotli` module if it is installed, ``None`` otherwise.
+    """
+    try:
+        return importlib.import_module('brotli')
+    except ImportError:
+        return None
+
+
+def _accept_encoding():
+    """
+    Returns the ``Accept-Encoding`` header value for release pages.
+    """
+    if _brotli() is not None:
+        return 'gzip, deflate, br'
+    return 'gzip, deflate'
+
+
+class _ContentDecoder:
+    """
+    Incrementally undoes the ``Content-Encoding`` **encoding** of a body fed
+    in chunks: ``gzip``, ``deflate`` (with or without its zlib header),
+    ``br`` if :mod:`brotli` is installed, or none.
+    """
+
+    def __init__(self, encoding):
+        self._encoding = (encoding or 'identity').strip().lower()
+        self._head = b''
+        if self._encoding in ('gzip', 'x-gzip'):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self._encoding == 'deflate':
+            self._decompressor = zlib.decompressobj()
+        elif self._encoding == 'br' and _brotli() is not None:
+            self._decompressor = _brotli().Decompressor()
+        elif self._encoding == 'identity':
+            self._decompressor = None
+        else:
+            raise ValueError("Unsupported Content-Encoding {!r}".format(
+                encoding))
+
+    def decompress(self, chunk):
+        """
+        Returns the decoded bytes of the next **chunk**.
+        """
+        if self._decompressor is None or not chunk:
+            return chunk
+        if self._encoding == 'br':
+            return self._decompressor.process(chunk)
+        if self._head is not None:
+            self._head += chunk
+        try:
+            data = self._decompressor.decompress(chunk)
+        except zlib.error:
+            # Some servers send raw deflate data without the zlib header.
+            if self._encoding != 'deflate' or self._head is None:
+                raise
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self._decompressor.decompress(self._head)
+        if data:
+            self._head = None
+        return data
+
+    def flush(self):
+        """
+        Returns what is left of the decoded body.
+        """
+        if self._decompressor is None or self._encoding == 'br':
+            return b''
+        return self._decompressor.flush()
+
+
+def _next_link(header):
+    """
+    Extracts the ``rel="next"`` target out of a ``Link`` **header**.
+    """
+    for target, rels in _LINK_RE.findall(header or ''):
+        if 'next' in rels.lower().split():
+            return target
+    return None
+
+
+def _url_joiner(base_url):
+    """
+    Returns a function equivalent to ``urljoin(base_url, href)``.
+
+    The common shapes of release links (absolute, root relative and plain
+    file names) are joined with simple concatenation, everything else goes
+    through :func:`urllib.parse.urljoin`.
+    """
+    parts = urlsplit(base_url)
+    origin = '{}://{}'.format(parts.scheme, parts.netloc)
+    folder = origin + (parts.path or '/').rsplit('/', 1)[0] + '/'
+
+    def join(href):
+        if '/.' in href or href.startswith(('.', '//', '?', '#')):
+            return urljoin(base_url, href)
+        if href.startswith(('http://', 'https://')):
+            return href
+        if ':' in href.split('/', 1)[0]:
+            return urljoin(base_url, href)
+        if href.startswith('/'):
+            return origin + href
+        return folder + href
+
+    if not parts.scheme or not parts.netloc:
+        return lambda href: urljoin(base_url, href)
+    return join
+
+
+class _FileMatcher:
+    """
+    Builds a ``{file_url: file_version}`` dictionary for each of the
+    **regexes** out of the anchors whose href matches it, also keeping
+    the url of the first anchor marked as ``rel="next"``.
+    """
+    # A feed-only consumer of _AnchorScanner's output.
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, base_url, regexes):
+        self._patterns = [_compile_file_regex(regex) for regex in regexes]
+        self._join = _url_joiner(base_url)
+        self.file_dicts = [{} for _ in regexes]
+        self.next_url = None
+
+    def feed(self, anchors):
+        """
+        Matches the ``(href, rel)`` **anchors** against every regex.
+        """
+        join = self._join
+        matches = list(zip(self._patterns, self.file_dicts))
+        for href, rel in anchors:
+            for pattern, file_dict in matches:
+                match = pattern.match(href)
+                if match is not None:
+                    file_dict[join(href)] = match.group(1)
+            if rel and self.next_url is None and (
+                    'next' in rel.lower().split()):
+                self.next_url = join(href)
+
+
+class _PageScan:
+    """
+    The transport independent half of fetching a release page and scanning
+    it for all **regexes**, shared by the blocking and asyncio functions.
+
+    If :attr:`fresh`, get the result from :meth:`cached` without sending a
+    request. Otherwise send the request with the :attr:`headers`, which ask
+    for a compressed body and, if :attr:`conditional`, only if the page
+    changed. If the answer was ``304 Not Modified``, get the result from
+    :meth:`not_modified`.
+    Otherwise pass the response headers to :meth:`start`, each chunk of the
+    body to :meth:`feed` and get the result from :meth:`finish`.
+
+    Results are the list of ``{file_url: file_version}`` dictionaries, one
+    per regex, and the url of the next page, taken from either the ``Link``
+    header or an ``<a rel="next">`` element, or ``None`` on the last page.
+    """
+    # Holds the whole state of a page being fetched and scanned.
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, base_url, regexes, cache=None):
+        self.base_url = base_url
+        self.regexes = regexes
+        self.cache = cache
+        self.entry = cache.get(base_url) if cache is not None else None
+        self.headers = {'Accept-Encoding': _accept_encoding()}
+        self.conditional = self.fresh = False
+        if self.entry is not None and all(
+                regex in self.entry['results'] for regex in regexes):
+            self.fresh = time.time() - self.entry.get(
+                'stored', 0) < cache.max_age
+            if self.entry.get('etag'):
+                self.headers['If-None-Match'] = self.entry['etag']
+                self.conditional = True
+            if self.entry.get('last_modified'):
+                self.headers['If-Modified-Since'] = self.entry['last_modified']
+                self.conditional = True
+        self._validators = (None, None)
+        self._next_url = None
+        self._decoder = None
+        self._scanner = None
+        self._matcher = None
+
+    def cached(self):
+        """
+        Returns the cached results.
+        """
+        return ([dict(self.entry['results'][regex])
+                 for regex in self.regexes], self.entry.get('next'))
+
+    def not_modified(self):
+        """
+        Returns the cached results, refreshing the cache entry.
+        """
+        self.cache.put(self.base_url, self.entry)
+        return self.cached()
+
+    def start(self, headers):
+        """
+        Reads the response **headers** before scanning the body.
+        """
+        self._validators = (headers.get('ETag'), headers.get('Last-Modified'))
+        self._next_url = _next_link(headers.get('Link'))
+        self._decoder = _ContentDecoder(headers.get('Content-Encoding'))
+        self._scanner = _AnchorScanner(headers.get_content_charset())
+        self._matcher = _FileMatcher(self.base_url, self.regexes)
+
+    def feed(self, chunk):
+        """
+        Scans the next **chunk** of the body.
+        """
+        self._matcher.feed(self._scanner.feed(self._decoder.decompress(
+            chunk)))
+
+    def finish(self):
+        """
+        Scans what was left of the body and returns the results, storing
+        them in the cache if the page can be validated later.
+        """
+        self._matcher.feed(self._scanner.feed(self._decoder.flush(),
+                                              final=True))
+        file_dicts = self._matcher.file_dicts
+        if self._next_url is not None:
+            next_url = urljoin(self.base_url, self._next_url)
+        else:
+            next_url = self._matcher.next_url
+
+        etag, last_modified = self._validators
+        if self.cache is not None and (etag or last_modified):
+            results = {}
+            entry = self.entry
+            if entry is not None and (entry.get('etag'), entry.get(
+                    'last_modified')) == self._validators:
+                results = entry['results']
+            results.update(zip(self.regexes, file_dicts))
+            self.cache.put(self.base_url, {'etag': etag,
+                                           'last_modified': last_modified,
+                                           'next': next_url,
+                                           'results': results})
+
+        return file_dicts, next_url
+
+
+def get_file_urls(base_url, regex, cache=None, session=None):
+    """
+    Inspired by uscan, the debian packaging utility.
+
+    Looks through all ``<a href="*">`` references to files in the given
+    base url and extracts them into a dictionary of (file_url, file_version)
+    value-pairs.
+
+    The **regex** argument is a regular expression that matches the file name.
+    It MUST have the file's version in a capturing group and this MUST be the
+    first group (``\\1`` backreference).
+
+    As an example, consider a project named *b* by *a* which deploys
+    to Github Releases with filenames such as *b-1.0.0.zip*. The function
+    call would look like::
+
+        >>> base_url = "https://github.com/a/b/releases"
+        >>> regex = r"b-(\\d+\\.\\d+\\.\\d+)\\.zip"
+        >>> result = get_file_urls(base_url, regex)
+        >>> result
+        {"https://github.com/a/b/releases/download/1.0.0/b-1.0.0.zip": "1.0.0"}
+
+    If a :class:`~keepitfresh.PageCache` is passed in **cache**, the page is
+    only downloaded and scanned again when the server reports that it changed
+    since the last check. The page is fetched through **session** if passed,
+    see :class:`~keepitfresh.Session`.
+
+    The page is requested compressed with gzip or deflate, or brotli if the
+    ``brotli`` package is installed, and decompressed as it is scanned. Its
+    charset is taken from the ``Content-Type`` header, or else from the page
+    itself, and defaults to UTF-8.
+    """
+    return _get_page(base_url, (regex,), cache, session=session)[0][0]
+
+
+def _get_page(base_url, regexes, cache=None, tracer=None, session=None):
+    """
+    Fetches a single release page and scans it once for all **regexes**.
+    See :class:`_PageScan` for the results.
+    """
+    _check_race()
+    scan = _PageScan(base_url, regexes, cache)
+    with _Span(tracer, 'fetch_index', url=base_url) as fetch:
+        if scan.fresh:
+            fetch.info['cached'] = True
+            return scan.cached()
+        with _urlopen(base_url, scan.headers, session=session) as web:
+            if scan.conditional and web.getcode() == 304:
+                fetch.info['not_modified'] = True
+                return scan.not_modified()
+            scan.start(web.headers)
+            size = 0
+            scanning = _Span(tracer, 'scan', url=base_url)
+            scan_time = 0.0
+            for chunk in iter(partial(web.read, _CHUNK_SIZE), b''):
+                _check_race()
+                size += len(chunk)
+                clock = time.perf_counter()
+                scan.feed(chunk)
+                scan_time += time.perf_counter() - clock
+        clock = time.perf_counter()
+        result = scan.finish()
+        scan_time += time.perf_counter() - clock
+        scanning.finish(scan_time, files=len(result[0][0]))
+        fetch.info['bytes'] = size
+    return result
+
+
+@lru_cache(maxsize=64 * 1024)
+def _parse_version(version):
+    """
+    Parses **version** with :func:`packaging.version.parse`, caching the
+    result.
+    """
+    from packaging.version import parse
+    return parse(version)
+
+
+def _is_newer(version, other, vcmp=None):
+    """
+    Whether **other** is newer than **version**.
+    """
+    if vcmp is not None:
+        return vcmp(version, other)
+    return _parse_version(version) < _parse_version(other)
+
+
+def _has_passed(file_dict, current_version, vcmp=None):
+    """
+    Whether a page of a newest first listing has gone past
+    **current_version**, i.e. it has versions and none of them is newer.
+    """
+    return bool(file_dict) and not any(
+        _is_newer(current_version, version, vcmp)
+        for version in file_dict.values())
+
+
+def _version_key(vcmp=None):
+    """
+    Returns a key function that sorts version strings from oldest to newest.
+
+    The default key parses each version string only once. A pairwise **vcmp**
+    function is adapted into a key with :func:`functools.cmp_to_key`.
+    """
+    if vcmp is None:
+        return _parse_version
+
+    def compare(version, other):
+        if vcmp(version, other):
+            return -1
+        if vcmp(other, version):
+            return 1
+        return 0
+
+    return cmp_to_key(compare)
+
+
+def _filter_versions(file_dict, prereleases=True):
+    """
+    Yields the ``(file_url, file_version)`` pairs in **file_dict**, skipping
+    pre-releases unless **prereleases** is ``True``.
+    """
+    if hasattr(file_dict, 'items'):
+        file_dict = file_dict.items()
+    for url, version in file_dict:
+        if prereleases or not _parse_version(version).is_prerelease:
+            yield url, version
+
+
+def rank_versions(file_dict, current_version=None, vcmp=None,
+                  prereleases=True, limit=None):
+    """
+    Sorts the ``(file_url, file_version)`` pairs in **file_dict** from newest
+    to oldest and returns them as a list.
+
+    If **current_version** is passed, only versions newer than it are kept.
+    If **limit** is passed, only the newest **limit** pairs are returned.
+    Pre-releases are left out when **prereleases** is ``False``; telling them
+    apart always uses the
+    `packaging <https://packaging.pypa.io/en/latest/version/>`_ package.
+
+    **file_dict** and **vcmp** work as in
+    :func:`~keepitfresh.get_update_version`.
+    """
+    key = _version_key(vcmp)
+    matches = _filter_versions(file_dict, prereleases)
+    if current_version is not None:
+        current_key = key(current_version)
+        matches = (match for match in matches
+                   if current_key < key(match[1]))
+
+    def match_key(match):
+        return key(match[1])
+
+    if limit is not None:
+        return nlargest(limit, matches, key=match_key)
+    return sorted(matches, key=match_key, reverse=True)
+
+
+def iter_file_urls(base_url, regex, current_version=None, vcmp=None, *,
+                   max_pages=None, cache=None, tracer=None, session=None):
+    """
+    Lazily yields the same ``(file_url, file_version)`` pairs as
+    :func:`~keepitfresh.get_file_urls`, following the listing's pagination
+    (either a ``Link: <...>; rel="next"`` header or an ``<a rel="next">``
+    element) to fetch the next page only once the current one is exhausted.
+    At most **max_pages** pages are fetched, or every page if ``None``.
+
+    Release listings are expected to show the newest releases first, so if
+    **current_version** is passed no more pages are fetched after a page
+    whose versions are all older than or equal to it. **vcmp** works as in
+    :func:`~keepitfresh.get_update_version`.
+
+    **cache** works as in :func:`~keepitfresh.get_file_urls` and applies to
+    every page, as does **session**. **tracer** receives the timings of
+    every page, see :class:`~keepitfresh.TraceCollector`.
+    """
+    url = base_url
+    visited = set()
+    while url is not None and url not in visited:
+        if max_pages is not None and len(visited) >= max_pages:
+            return
+        visited.add(url)
+        file_dicts, url = _get_page(url, (regex,), cache, tracer, session)
+        file_dict = file_dicts[0]
+
+        for file_url, version in file_dict.items():
+            yield file_url, version
+
+        if current_version is not None and _has_passed(
+                file_dict, current_version, vcmp):
+            return
+
+
+def get_update_version(file_dict, current_version, vcmp=None,
+                       prereleases=True):
+    """
+    Look through a dictionary that maps file urls to version strings, much like
+    the one returned by :func:`~keepitfresh.get_file_urls`, and get the latest
+    version and corresponding file url. If no version newer than
+    **current_version** is found, returns an empty tuple.
+
+    An iterable of ``(file_url, file_version)`` pairs, such as the one
+    returned by :func:`~keepitfresh.iter_file_urls`, is also accepted.
+
+    **current_version** should be a string in the same pattern as used in
+    :func:`~keepitfresh.get_file_urls`.
+
+    To get the latest version, a comparison function is used. The default uses
+    the comparison from the
+    `packaging <https://packaging.pypa.io/en/latest/version/>`_ package. To
+    override this, pass a function in **vcmp** that accepts two version strings
+    and returns ``True`` whenever the second version string is newer than the
+    first version string.
+
+    Pre-releases are skipped when **prereleases** is ``False``. To get more
+    than the single latest version, see :func:`~keepitfresh.rank_versions`.
+    """
+    key = _version_key(vcmp)
+
+    def match_key(match):
+        return key(match[1])
+
+    matches = _filter_versions(file_dict, prereleases)
+    freshest_match = max(matches, key=match_key, default=None)
+
+    if freshest_match is None or not (
+            key(current_version) < match_key(freshest_match)):
+        return ()
+    return freshest_match
+
+
+class DownloadCache:
+    """
+    A cache for the archives downloaded by :func:`~keepitfresh.dl_unpack`
+    that can be shared by every process on a host.
+
+    Entries are keyed by the archive's url and its ``ETag`` (or
+    ``Last-Modified`` date), so a file replaced on the server is downloaded
+    again. A lock file per entry ensures only one process downloads an
+    archive while the others wait for it and then reuse it. Interrupted
+    downloads are resumed the next time they are attempted.
+
+    **cache_dir** is the folder where archives are stored and is created if
+    needed. Whenever the stored archives take up more than **max_size**
+    bytes, the least recently used ones that are not in use are evicted.
+    """
+
+    def __init__(self, cache_dir, max_size=1024 * 1024 * 1024):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+
+    def _key(self, url, session=None):
+        try:
+            with _urlopen(url, method='HEAD', session=session) as head:
+                validator = _validator(head.headers) or ''
+        except OSError:
+            # Servers refusing HEAD requests are only keyed by url.
+            validator = ''
+        key = '{}\n{}'.format(url, validator).encode('utf8')
+        return hashlib.sha256(key).hexdigest()
+
+    @contextmanager
+    def fetch(self, url, *, segments=1, min_segment_size=_MIN_SEGMENT_SIZE,
+              hasher=None, session=None):
+        """
+        Downloads **url** unless it is already cached and yields the path of
+        the cached archive, which is kept locked until the ``with`` block
+        exits. **segments** and **min_segment_size** work as in
+        :func:`~keepitfresh.dl_unpack`, as does **session**.
+
+        The archive's bytes are fed to the :mod:`hashlib` object **hasher**,
+        if passed, before it is yielded. If the ``with`` block raises an
+        :class:`~keepitfresh.IntegrityError` the archive is removed.
+        """
+        key = self._key(url, session)
+        entry_dir = os.path.join(self.cache_dir, key)
+        file_path = os.path.join(entry_dir, url.rsplit('/', 1)[1])
+        with self._locked(key):
+            os.makedirs(entry_dir, exist_ok=True)
+            try:
+                if os.path.exists(file_path):
+                    os.utime(file_path)
+                    if hasher is not None:
+                        _hash_file(file_path, hasher)
+                else:
+                    part_path = file_path + '.part'
+                    _download(url, part_path, segments=segments,
+                              min_segment_size=min_segment_size,
+                              resume=True, hasher=hasher, session=session)
+                    os.replace(part_path, file_path)
+                    os.remove(part_path + _STATE_SUFFIX)
+                    self._evict(key)
+                yield file_path
+            except IntegrityError:
+                self._discard(key)
+                raise
+
+    def clear(self):
+        """
+        Removes every archive from the cache that is not in use.
+        """
+        for _, _, key in self._entries():
+            self._remove(key)
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.endswith('.lock') or not os.path.isdir(entry_dir):
+                continue
+            size = used = 0
+            for filename in os.listdir(entry_dir):
+                try:
+                    file_st = os.stat(os.path.join(entry_dir, filename))
+                except OSError:
+                    continue
+                size += file_st.st_size
+                used = max(used, file_st.st_mtime)
+            entries.append((used, size, name))
+        return entries
+
+    def _evict(self, keep):
+        entries = self._entries()
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, key in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if key != keep and self._remove(key):
+                total_size -= size
+
+    @contextmanager
+    def _locked(self, key, blocking=True):
+        """
+        Holds the lock of the entry **key** for the ``with`` block and
+        yields whether it was taken, which is always the case if
+        **blocking**.
+
+        Lock files are removed along with their entry, so a lock taken on
+        a file that was removed in the meantime is taken again on the file
+        that replaced it.
+        """
+        lock_path = os.path.join(self.cache_dir, key + '.lock')
+        while True:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(lock_path, 'a+b') as lock_file:
+                if not _lock(lock_file, blocking):
+                    yield False
+                    return
+                try:
+                    try:
+                        current = os.path.samestat(
+                            os.fstat(lock_file.fileno()), os.stat(lock_path))
+                    except FileNotFoundError:
+                        current = False
+                    if current:
+                        yield True
+                        return
+                finally:
+                    _unlock(lock_file)
+
+    def _discard(self, key):
+        """
+        Removes the entry **key** and its lock file, whose lock must be
+        held. Windows can't remove open files, so there the lock file is
+        removed by :meth:`_remove` once it is closed.
+        """
+        from shutil import rmtree
+        rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+        if fcntl is not None:
+            os.remove(os.path.join(self.cache_dir, key + '.lock'))
+
+    def _remove(self, key):
+        """
+        Removes the entry **key** unless another process is using it and
+        returns whether it did.
+        """
+        with self._locked(key, blocking=False) as locked:
+            if not locked:
+                return False
+            self._discard(key)
+        if fcntl is None:
+            try:
+                os.remove(os.path.join(self.cache_dir, key + '.lock'))
+            except OSError:  # opened again by another process
+                pass
+        return True
+
+
+def _lock(lock_file, blocking=True):
+    """
+    Takes an exclusive lock on the open **lock_file**, waiting for it if
+    **blocking**. Returns whether the lock was taken.
+    """
+    if fcntl is not None:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file.fileno(), flags)
+        except OSError as exc:
+            if exc.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    lock_file.seek(0)
+    while True:
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            if not blocking:
+                return False
+            time.sleep(0.1)
+
+
+def _unlock(lock_file):
+    """
+    Releases the lock taken with :func:`_lock`.
+    """
+    if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def dl_unpack(url, outdir, unpack=None, *, segments=1,
+              min_segment_size=_MIN_SEGMENT_SIZE, staging_dir=None,
+              stream=False, download_cache=None, checksum=None,
+              hash_name='sha256', verify=None, tracer=None, session=None,
+              mirrors=None, scores=None):
+    """
+    Downloads the archive in **url** and unpacks it to **outdir**.
+
+    Unpacking is handled by :func:`~keepitfresh.unpack_archive`, which
+    unpacks common formats in-process and everything else with
+    `patool <http://wummel.github.io/patool/>`_. Pass ``'patool'`` in
+    **unpack** to use patool for every format. If you need to override
+    this, you can a function in **unpack** that accepts the archive path as
+    the first argument and the output folder as the second argument.
+
+    If **segments** is larger than 1 and the server supports ``Range``
+    requests, the archive is downloaded over up to **segments** parallel
+    connections, each fetching at least **min_segment_size** bytes.
+    Otherwise it is downloaded over a single connection.
+
+    By default the archive is downloaded to a temporary folder. If a
+    **staging_dir** is passed instead, the archive is downloaded there along
+    with a small state file, so a download interrupted by a crash or a
+    network failure resumes where it stopped the next time it is attempted,
+    provided the server still has the same file (checked with
+    ``If-Range``). Both are removed once the archive is unpacked.
+
+    If **stream** is ``True`` and **unpack** is left as default, *tar*
+    archives (optionally compressed with gzip, bzip2 or xz) are unpacked
+    while they are downloaded, without being written to disk, and *zip*
+    archives are downloaded to a spooled buffer that only spills to disk
+    when large, and unpacked from there. Both use the standard library and
+    ignore **segments** and **staging_dir**. Other formats are downloaded
+    and unpacked as usual.
+
+    If a :class:`~keepitfresh.DownloadCache` is passed in **download_cache**,
+    the archive is unpacked from the cache, downloading it there first if
+    needed, and **staging_dir** is ignored.
+
+    If a hex **checksum** is passed, the archive's **hash_name** digest
+    (any :mod:`hashlib` algorithm, such as ``'sha256'`` or ``'blake2b'``)
+    must match it, see :func:`~keepitfresh.get_checksums`. **verify** can be
+    a function that takes **url** and the finished :mod:`hashlib` object,
+    for example to check the digest against a detached signature published
+    next to the archive, and returns whether the archive is genuine. The
+    digest is computed as the archive is downloaded, so neither adds another
+    pass over the file unless it is downloaded in segments, resumed or taken
+    from **download_cache**. An :class:`~keepitfresh.IntegrityError` is
+    raised if either check fails, before unpacking or, when streaming, once
+    the archive was unpacked to **outdir**, which should then be discarded.
+
+    **tracer** receives the timings of the download and unpacking, see
+    :class:`~keepitfresh.TraceCollector`. Every request goes through
+    **session** if passed, see :class:`~keepitfresh.Session`.
+
+    **mirrors** can list other urls serving the same archive. The archive
+    is then downloaded from the mirror with the best throughput in
+    **scores**, a :class:`~keepitfresh.MirrorScores`, (or **url** first
+    without it) and, if that mirror fails mid-transfer, the download
+    resumes from the next one with a ``Range`` request. **segments**,
+    **staging_dir**, **stream** and **download_cache** are ignored in that
+    case.
+    """
+    from tempfile import TemporaryDirectory
+    fname = url.rsplit('/', 1)[1]
+    hasher = (hashlib.new(hash_name)
+              if checksum is not None or verify is not None else None)
+
+    if mirrors:
+        urls = [url] + list(mirrors)
+        if scores is not None:
+            urls = scores.rank(urls, 'throughput')
+        with TemporaryDirectory() as tmpdir:
+            file_path = os.path.join(tmpdir, fname)
+            with _Span(tracer, 'download', url=url) as span:
+                span.info['url'] = _download_mirrored(urls, file_path, hasher,
+                                                      session, scores)
+                span.info['bytes'] = os.path.getsize(file_path)
+            _check_integrity(url, hasher, checksum, verify)
+            _unpack(file_path, outdir, unpack, tracer)
+        return
+
+    if stream and unpack in (None, 'builtin') and (
+            _archive_format(fname) is not None):
+        with _Span(tracer, 'download', url=url, streamed=True) as span, \
+                _urlopen(url, session=session) as response:
+            reader = _HashingReader(response, hasher)
+            _stream_unpack(reader, fname, outdir)
+            while reader.read(_CHUNK_SIZE):
+                pass
+            span.info['bytes'] = reader.size
+            if tracer is not None:
+                span.info['files'] = _count_files(outdir)
+        _check_integrity(url, hasher, checksum, verify)
+        return
+
+    if download_cache is not None:
+        with _Span(tracer, 'download', url=url) as span, \
+                download_cache.fetch(url, segments=segments,
+                                     min_segment_size=min_segment_size,
+                                     hasher=hasher, session=session) as path:
+            span.finish(bytes=os.path.getsize(path))
+            _check_integrity(url, hasher, checksum, verify)
+            _unpack(path, outdir, unpack, tracer)
+        return
+
+    if staging_dir is not None:
+        os.makedirs(staging_dir, exist_ok=True)
+        file_path = os.path.join(staging_dir, fname)
+        with _Span(tracer, 'download', url=url) as span:
+            _download(url, file_path, segments=segments,
+                      min_segment_size=min_segment_size, resume=True,
+                      hasher=hasher, session=session)
+            span.info['bytes'] = os.path.getsize(file_path)
+        try:
+            _check_integrity(url, hasher, checksum, verify)
+        except IntegrityError:
+            for path in (file_path, file_path + _STATE_SUFFIX):
+                os.remove(path)
+            raise
+        _unpack(file_path, outdir, unpack, tracer)
+        for path in (file_path, file_path + _STATE_SUFFIX):
+            os.remove(path)
+        return
+
+    with TemporaryDirectory() as tmpdir:
+        file_path = os.path.join(tmpdir, fname)
+        with _Span(tracer, 'download', url=url) as span:
+            _download(url, file_path, segments=segments,
+                      min_segment_size=min_segment_size, hasher=hasher,
+                      session=session)
+            span.info['bytes'] = os.path.getsize(file_path)
+        _check_integrity(url, hasher, checksum, verify)
+        _unpack(file_path, outdir, unpack, tracer)
+
+
+def get_checksums(base_url, regex=r'SHA256SUMS', cache=None, session=None):
+    """
+    Looks through **base_url** for checksum files whose name matches
+    **regex**, such as the ``SHA256SUMS`` files written by ``sha256sum``,
+    and returns a dictionary of ``(file_name, hex_digest)`` value-pairs
+    merged from all of them, to pass to :func:`~keepitfresh.dl_unpack`.
+
+    Both the GNU (``<digest>  <file_name>``) and BSD
+    (``SHA256 (<file_name>) = <digest>``) formats are understood. **cache**
+    and **session** work as in :func:`~keepitfresh.get_file_urls`.
+    """
+    checksums = {}
+    for url in get_file_urls(base_url, '(' + regex + ')', cache, session):
+        with _urlopen(url, session=session) as response:
+            text = response.read().decode('utf8', 'replace')
+        for line in text.splitlines():
+            match = _CHECKSUM_RE.match(line) or _BSD_CHECKSUM_RE.match(line)
+            if match:
+                name = match.group('name').replace('\\', '/')
+                checksums[name.rsplit('/', 1)[-1]] = (
+                    match.group('digest').lower())
+    return checksums
+
+
+class _HashingReader:
+    """
+    Wraps the **stream** so everything read from it also updates the
+    :mod:`hashlib` object **hasher**, if not ``None``, and counts the
+    ``size`` read so far.
+    """
+    # Only read is needed by copyfileobj.
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, stream, hasher):
+        self._stream = stream
+        self._hasher = hasher
+        self.size = 0
+
+    def read(self, size=-1):
+        """
+        Reads up to **size** bytes from the stream, hashing them.
+        """
+        data = self._stream.read(size)
+        self.size += len(data)
+        if self._hasher is not None:
+            self._hasher.update(data)
+        return data
+
+
+def _hash_file(file_path, hasher):
+    """
+    Feeds the contents of **file_path** to the :mod:`hashlib` **hasher**.
+    """
+    with open(file_path, 'rb') as in_file:
+        for chunk in iter(partial(in_file.read, _CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+
+def _check_integrity(url, hasher, checksum=None, verify=None):
+    """
+    Raises :class:`~keepitfresh.IntegrityError` if the archive from **url**
+    hashed into **hasher** does not match **checksum** or **verify**.
+    """
+    if checksum is not None and hasher.hexdigest() != checksum.lower():
+        raise IntegrityError("Checksum mismatch for {}".format(url))
+    if verify is not None and not verify(url, hasher):
+        raise IntegrityError("Verification failed for {}".format(url))
+
+
+def _download(url, file_path, *, segments=1,
+              min_segment_size=_MIN_SEGMENT_SIZE, resume=False, hasher=None,
+              session=None):
+    """
+    Downloads **url** to **file_path**, see :func:`~keepitfresh.dl_unpack`.
+
+    If **resume** is ``True``, the progress is kept in a state file next to
+    **file_path** and an earlier, interrupted, download is resumed.
+
+    The downloaded bytes are fed to the :mod:`hashlib` object **hasher**, if
+    passed, as they arrive over a single connection and from the finished
+    file otherwise.
+    """
+    from shutil import copyfileobj
+    state_path = file_path + _STATE_SUFFIX if resume else None
+    if resume:
+        state = _read_state(state_path)
+        if state is not None and state.get('url') == url:
+            try:
+                if _resume_download(url, file_path, state, state_path,
+                                    session):
+                    if hasher is not None:
+                        _hash_file(file_path, hasher)
+                    return
+            except _RangeNotSatisfied:
+                pass
+
+    if segments > 1 and urlsplit(url).scheme in ('http', 'https'):
+        range_url, length, validator = (_probe_ranges(url, session) or
+                                        (url, 0, None))
+        count = min(segments, length // max(min_segment_size, 1))
+        if count > 1:
+            state = {
+                'url': url,
+                'validator': validator,
+                'length': length,
+                'bounds': [length * index // count
+                           for index in range(count + 1)],
+                'done': []}
+            with open(file_path, 'wb') as out_file:
+                out_file.truncate(length)
+            try:
+                _download_segments(range_url, file_path, state, state_path,
+                                   session)
+                if hasher is not None:
+                    _hash_file(file_path, hasher)
+                return
+            except _RangeNotSatisfied:
+                pass
+
+    with _urlopen(url, session=session) as response:
+        if state_path is not None:
+            length = response.headers.get('Content-Length')
+            _write_state(state_path, {
+                'url': url,
+                'validator': _validator(response.headers),
+                'length': int(length) if length else None})
+        with open(file_path, 'wb') as out_file:
+            copyfileobj(_HashingReader(response, hasher), out_file)
+
+
+def _probe_ranges(url, session=None):
+    """
+    Asks the server with a ``HEAD`` request whether **url** can be
+    downloaded in ranges, returning its ``(url, length, validator)`` once
+    redirects are followed, or ``None`` if it can't or the server refuses
+    ``HEAD`` requests, as some answer them with a 403 or 405.
+    """
+    try:
+        with _urlopen(url, method='HEAD', session=session) as head:
+            if head.headers.get('Accept-Ranges', '').lower() != 'bytes':
+                return None
+            return (head.geturl(),
+                    int(head.headers.get('Content-Length') or 0),
+                    _validator(head.headers))
+    except (OSError, ValueError):
+        return None
+
+
+def _validator(headers):
+    """
+    Returns the value to send in ``If-Range`` for a response with these
+    **headers**: its strong ``ETag`` or else its ``Last-Modified`` date.
+    """
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def _read_state(state_path):
+    """
+    Reads the download state in **state_path**, ``None`` if unreadable.
+    """
+    try:
+        with open(state_path, 'r', encoding='utf8') as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_state(state_path, state):
+    """
+    Atomically replaces the download state in **state_path**.
+    """
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, state_path)
+
+
+def _resume_download(url, file_path, state, state_path, session=None):
+    """
+    Resumes the interrupted download of **url** described by **state**.
+
+    Returns ``False`` if there is nothing that can be resumed.
+    """
+    from shutil import copyfileobj
+    from urllib.error import HTTPError
+    if not os.path.exists(file_path) or not state.get('validator'):
+        return False
+    if 'bounds' in state:
+        _download_segments(url, file_path, state, state_path, session)
+        return True
+
+    offset = os.path.getsize(file_path)
+    if offset == state.get('length'):
+        return True
+
+    headers = {'Range': 'bytes={}-'.format(offset),
+               'If-Range': state['validator']}
+    try:
+        response = _urlopen(url, headers, session=session)
+    except HTTPError as exc:
+        if exc.code == 416:
+            return False
+        raise
+    with response:
+        content_range = response.headers.get('Content-Range', '')
+        if response.getcode() == 206 and content_range.startswith(
+                'bytes {}-'.format(offset)):
+            mode = 'ab'
+        else:
+            mode = 'wb'
+            length = response.headers.get('Content-Length')
+            _write_state(state_path, dict(
+                state, validator=_validator(response.headers),
+                length=int(length) if length else None))
+        with open(file_path, mode) as out_file:
+            copyfileobj(response, out_file)
+    return True
+
+
+class _RaceLost(Exception):
+    """
+    Raised in the calls of :func:`~keepitfresh.race_mirrors` that lost the
+    race, to stop them.
+    """
+
+
+_RACE = threading.local()
+
+
+def _check_race():
+    """
+    Raises :exc:`_RaceLost` if this thread runs a call of
+    :func:`~keepitfresh.race_mirrors` that another call already won.
+    """
+    lost = getattr(_RACE, 'lost', None)
+    if lost is not None and lost.is_set():
+        raise _RaceLost()
+
+
+class _RangeNotSatisfied(Exception):
+    """
+    Raised when the server ignores or rejects a ``Range`` request.
+    """
+
+
+def _download_range(url, file_path, start, end, *, validator=None,
+                    session=None):
+    """
+    Downloads bytes **start** to **end** (inclusive) of **url** into the
+    same position of the already allocated **file_path**, provided the
+    file still matches **validator**.
+    """
+    from http.client import IncompleteRead
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    if validator:
+        headers['If-Range'] = validator
+    with _urlopen(url, headers, session=session) as response, \
+            open(file_path, 'r+b') as out_file:
+        content_range = response.headers.get('Content-Range', '')
+        if response.getcode() != 206 or not content_range.startswith(
+                'bytes {}-'.format(start)):
+            raise _RangeNotSatisfied(content_range)
+        out_file.seek(start)
+        remaining = end - start + 1
+        while remaining:
+            chunk = response.read(min(_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise IncompleteRead(b'', remaining)
+            out_file.write(chunk)
+            remaining -= len(chunk)
+
+
+def _download_segments(url, file_path, state, state_path=None,
+                       session=None):
+    """
+    Downloads the segments of **url** delimited by ``state['bounds']`` and
+    not yet in ``state['done']`` in parallel to the allocated **file_path**,
+    recording each finished segment in **state_path** if passed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    bounds = state['bounds']
+    pending = [index for index in range(len(bounds) - 1)
+               if index not in state['done']]
+    lock = threading.Lock()
+    if state_path is not None:
+        _write_state(state_path, state)
+
+    def fetch(index):
+        _download_range(url, file_path, bounds[index], bounds[index + 1] - 1,
+                        validator=state['validator'], session=session)
+        if state_path is not None:
+            with lock:
+                state['done'].append(index)
+                _write_state(state_path, state)
+
+    with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+        for future in [executor.submit(fetch, index) for index in pending]:
+            future.result()
+
+
+def _download_mirrored(urls, file_path, hasher=None, session=None,
+                       scores=None):
+    """
+    Downloads the same file from the first of **urls** that works to
+    **file_path**, continuing from the next one where the previous one
+    failed. Returns the url that finished the download.
+    """
+    from http.client import HTTPException, IncompleteRead
+    errors = []
+    offset = 0
+    with open(file_path, 'wb') as out_file:
+        for url in urls:
+            clock = time.perf_counter()
+            received = 0
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+            try:
+                with _urlopen(url, headers, session=session) as response:
+                    latency = time.perf_counter() - clock
+                    content_range = response.headers.get('Content-Range', '')
+                    if offset and (response.getcode() != 206 or
+                                   not content_range.startswith(
+                                       'bytes {}-'.format(offset))):
+                        raise _RangeNotSatisfied(content_range)
+                    length = response.headers.get('Content-Length')
+                    for chunk in iter(partial(response.read, _CHUNK_SIZE),
+                                      b''):
+                        out_file.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+                        received += len(chunk)
+                        offset += len(chunk)
+                    if length and received < int(length):
+                        raise IncompleteRead(b'', int(length) - received)
+            except (OSError, HTTPException, _RangeNotSatisfied) as exc:
+                if scores is not None:
+                    scores.record(url, failed=True)
+                errors.append(exc)
+                continue
+
+            if scores is not None:
+                duration = time.perf_counter() - clock
+                scores.record(url, latency, received / duration
+                              if duration > 0 and received else None)
+            return url
+    raise errors[-1]
+
+
+def _archive_format(fname):
+    """
+    Returns the :mod:`tarfile` stream mode, or ``'zip'``, for the archive
+    named **fname**, or ``None`` if the standard library can't unpack it.
+    """
+    fname = fname.lower()
+    for suffixes, mode in _ARCHIVE_FORMATS:
+        if fname.endswith(suffixes):
+            return mode
+    return None
+
+
+def _stream_unpack(response, fname, outdir):
+    """
+    Unpacks the archive named **fname** to **outdir** as it is read from
+    the **response** stream.
+    """
+    import tarfile
+    import zipfile
+    from shutil import copyfileobj
+    from tempfile import SpooledTemporaryFile
+    mode = _archive_format(fname)
+    if mode == 'zip':
+        with SpooledTemporaryFile(max_size=_SPOOL_SIZE) as spool:
+            copyfileobj(response, spool)
+            spool.seek(0)
+            with zipfile.ZipFile(spool) as archive:
+                _extract_zip(archive, outdir)
+    else:
+        with tarfile.open(fileobj=response, mode=mode) as archive:
+            _extract_tar(archive, outdir)
+
+
+def _extract_zip(archive, outdir):
+    """
+    Extracts the opened zip **archive** to **outdir**, keeping the unix
+    permissions of its members.
+    """
+    from platform import system
+    for info in archive.infolist():
+        path = archive.extract(info, outdir)
+        mode = info.external_attr >> 16 & 0o777
+        if mode and system() != 'Windows':
+            os.chmod(path, mode)
+
+
+def _extract_tar(archive, outdir):
+    """
+    Extracts the opened tar **archive** to **outdir**, refusing members that
+    would end up outside of it.
+    """
+    import tarfile
+    if hasattr(tarfile, 'data_filter'):
+        archive.extractall(outdir, filter='data')
+        return
+
+    outdir = os.path.realpath(outdir)
+
+    def checked_members():
+        for member in archive:
+            targets = [member.name]
+            if member.issym() or member.islnk():
+                targets.append(os.path.join(os.path.dirname(member.name),
+                                            member.linkname))
+            for target in targets:
+                path = os.path.realpath(os.path.join(outdir, target))
+                if os.path.commonpath([outdir, path]) != outdir:
+                    raise ValueError("Archive member {} is outside of the "
+                                     "output folder".format(member.name))
+            yield member
+
+    archive.extractall(outdir, members=checked_members())
+
+
+def _unpack(file_path, outdir, unpack=None, tracer=None):
+    """
+    Unpacks the archive in **file_path** to **outdir**, see
+    :func:`~keepitfresh.dl_unpack`.
+    """
+    from patoolib import extract_archive
+    with _Span(tracer, 'unpack') as span:
+        if unpack == 'patool':
+            extract_archive(file_path, outdir=outdir, verbosity=-1)
+        elif unpack is not None and unpack != 'builtin':
+            unpack(file_path, outdir)
+        else:
+            unpack_archive(file_path, outdir)
+        if tracer is not None:
+            span.info['bytes'] = os.path.getsize(file_path)
+            span.info['files'] = _count_files(outdir)
+
+
+def unpack_archive(archive_path, outdir, max_workers=None):
+    """
+    The default unpacking method of :func:`~keepitfresh.dl_unpack`.
+
+    *zip* and *tar* archives, optionally compressed with gzip, bzip2 or xz,
+    are unpacked in-process with the standard library. The members of a zip
+    archive are extracted in parallel on up to **max_workers** threads, by
+    default as many as there are CPUs, with the largest members first and
+    written straight to preallocated files. Other formats are handed to
+    `patool <http://wummel.github.io/patool/>`_.
+    """
+    import tarfile
+    from patoolib import extract_archive
+    mode = _archive_format(os.path.basename(archive_path))
+    if mode is None:
+        extract_archive(archive_path, outdir=outdir, verbosity=-1)
+    elif mode == 'zip':
+        _extract_zip_parallel(archive_path, outdir, max_workers)
+    else:
+        with tarfile.open(archive_path, 'r:*') as archive:
+            _extract_tar(archive, outdir)
+
+
+def _zip_member_path(info, outdir):
+    """
+    Returns the path the zip member **info** is extracted to, dropping any
+    part of its name that would take it outside of **outdir**.
+    """
+    name = info.filename
+    if os.path.altsep:
+        name = name.replace(os.path.altsep, os.path.sep)
+    name = os.path.splitdrive(name.replace('/', os.path.sep))[1]
+    parts = [part for part in name.split(os.path.sep)
+             if part not in ('', os.path.curdir, os.path.pardir)]
+    return os.path.join(outdir, *parts)
+
+
+def _extract_zip_parallel(archive_path, outdir, max_workers=None):
+    """
+    Extracts the zip archive in **archive_path** to **outdir** on a pool of
+    threads, each reading through its own handle to the archive.
+    """
+    import zipfile
+    from concurrent.futures import ThreadPoolExecutor
+    from platform import system
+    from shutil import copyfileobj
+    with zipfile.ZipFile(archive_path) as archive:
+        members = archive.infolist()
+
+    files = []
+    for info in members:
+        path = _zip_member_path(info, outdir)
+        if info.filename.endswith('/'):
+            os.makedirs(path, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            files.append((info, path))
+    files.sort(key=lambda member: member[0].file_size, reverse=True)
+
+    local = threading.local()
+    lock = threading.Lock()
+
+    def extract(info, path):
+        archive = getattr(local, 'archive', None)
+        if archive is None:
+            with lock:
+                archive = local.archive = handles.enter_context(
+                    zipfile.ZipFile(archive_path))
+        with archive.open(info) as source, open(path, 'wb') as target:
+            if info.file_size >= _PREALLOCATE_SIZE:
+                _preallocate(target, info.file_size)
+            copyfileobj(source, target, _CHUNK_SIZE * 16)
+
+    with ExitStack() as handles, ThreadPoolExecutor(
+            max_workers=max_workers or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(extract, info, path)
+                   for info, path in files]
+        for future in futures:
+            future.result()
+
+    if system() != 'Windows':
+        for info in members:
+            mode = info.external_attr >> 16 & 0o777
+            if mode:
+                os.chmod(_zip_member_path(info, outdir), mode)
+
+
+def _preallocate(out_file, size):
+    """
+    Reserves **size** bytes on disk for the open **out_file**.
+    """
+    try:
+        os.posix_fallocate(out_file.fileno(), 0, size)
+    except (AttributeError, OSError):
+        out_file.truncate(size)
+        out_file.seek(0)
+
+
+def overwrite_restart(initem, owitem, entry_point, *, mode='copy',
+                      tracer=None, keep_fds=None, keep_argv=False):
+    """
+    Overwrites the current application file/folder and restarts the process
+    with the updated application.
+
+    Inspired by PyUpdater, uses a separate process for Unix and Windows
+    (Windows does not allow file deletion while it's still being used so we
+    have to work around that).
+
+    **initem** can be either a file or a folder and is the path to the updated
+    application. **owitem** can be either a file or a folder and is the path
+    to the old application.
+
+    **entry_point** is the relative path from the parent folder of **owitem**
+    to the executable to restart with.
+
+    On Unix, **mode** chooses how **owitem** is replaced:
+
+    - ``'copy'`` - **owitem** is deleted and **initem** is copied in its
+      place. This is the default.
+    - ``'swap'`` - **initem** is moved next to **owitem** and swapped in
+      with renames, so no data is copied. A file replacing a file takes a
+      single, atomic, rename. Otherwise **owitem** is renamed aside and then
+      **initem** into place, so for the instant between both renames
+      neither is at that path; if the second rename fails, **owitem** is
+      renamed back. **initem** is only copied if it is on a different
+      filesystem, in which case it is left where it was; otherwise it no
+      longer exists afterwards.
+    - ``'incremental'`` - when both are folders, only the files of
+      **initem** that are new or differ from the ones in **owitem** are
+      written, files missing from **initem** are deleted and the rest are
+      left untouched. Files are compared through a manifest of sizes and
+      hashes that is kept next to **owitem** so unchanged files are not
+      read again on the next update. Otherwise works like ``'swap'``.
+
+    **tracer** receives the time taken to replace **owitem**, see
+    :class:`~keepitfresh.TraceCollector`.
+
+    On Unix, the process is restarted in place with ``exec`` so it keeps its
+    pid. If **keep_argv** is ``True``, the command line arguments of the
+    current process are passed on to **entry_point**. **keep_fds** is a list
+    of sockets or file descriptors, or a dict mapping names to them, that
+    stay open across the restart so listening sockets keep accepting
+    connections while the application restarts. They are handed over the
+    way systemd socket activation does it: as file descriptors 3 and up, in
+    order, with ``LISTEN_FDS``, ``LISTEN_PID`` and ``LISTEN_FDNAMES`` set in
+    the environment. The restarted application gets them back with
+    :func:`~keepitfresh.listen_fds`.
+
+    On Windows, the application is started again as a new process once the
+    old one has exited, so neither can be passed on: a :exc:`ValueError` is
+    raised, before anything is replaced, if **keep_fds** or **keep_argv**
+    is given.
+    """
+    import subprocess
+    from platform import system
+    from tempfile import TemporaryDirectory
+    initem = os.path.abspath(initem)
+    owitem = os.path.abspath(owitem)
+    owdir = os.path.dirname(owitem)
+    abs_path = os.path.join(owdir, entry_point)
+
+    if system() == 'Windows':  # pragma: no unix
+        if keep_fds is not None or keep_argv:
+            raise ValueError("keep_fds and keep_argv are not supported on "
+                             "Windows")
+        vbs_string = ('CreateObject("Wscript.Shell").Run """" '
+                      '& WScript.Arguments(0) & """", 0, False')
+
+        bat_string = "@echo off\n"
+
+        if os.path.isdir(owitem):
+            bat_string += "rd /s /q \"{}\"\n".format(owitem)
+        else:
+            bat_string += "del /q \"{}\"\n".format(owitem)
+
+        if os.path.isdir(initem):
+            dest = os.path.join(owdir, os.path.basename(initem))
+            bat_string += "robocopy \"{}\" \"{}\" /e\n".format(initem, dest)
+        else:
+            bat_string += "copy /y /b \"{}\" \"{}\"\n".format(initem, owdir)
+
+        bat_string += "start \"\" \"{}\"\n".format(abs_path)
+
+        with TemporaryDirectory() as tmpdir:
+            vbs_path = os.path.join(tmpdir, 'invisble.vbs')
+            bat_path = os.path.join(tmpdir, 'restart.bat')
+            with open(vbs_path, 'w', encoding='utf8') as vbs_file:
+                vbs_file.write(vbs_string)
+            with open(bat_path, 'w', encoding='utf8') as bat_file:
+                bat_file.write(bat_string)
+
+            args = ['wscript.exe', vbs_path, bat_path]
+            subprocess.Popen(args)
+            os._exit(0)
+
+    else:  # pragma: no windows
+        _overwrite(initem, owitem, mode, tracer)
+        _restart(abs_path, keep_fds, keep_argv)
+
+
+def _overwrite(initem, owitem, mode='copy', tracer=None):
+    """
+    Replaces **owitem** with **initem** on Unix, see
+    :func:`~keepitfresh.overwrite_restart`.
+    """
+    from shutil import copy2, copytree
+    owdir = os.path.dirname(owitem)
+    with _Span(tracer, 'overwrite', mode=mode):
+        if mode == 'incremental' and os.path.isdir(initem) and (
+                os.path.isdir(owitem)):
+            _apply_incremental(initem, owitem)
+        elif mode in ('swap', 'incremental'):
+            _swap(initem, owitem)
+        elif mode == 'copy':
+            _remove_item(owitem)
+            if os.path.isdir(initem):
+                copytree(initem,
+                         os.path.join(owdir, os.path.basename(initem)))
+            else:
+                copy2(initem, owdir)
+        else:
+            raise ValueError("Unknown overwrite mode {!r}".format(mode))
+
+
+def _restart(abs_path, keep_fds=None, keep_argv=False):
+    """
+    Makes **abs_path** executable and replaces the current process with it,
+    see :func:`~keepitfresh.overwrite_restart`.
+    """
+    fname = os.path.basename(abs_path)
+    filest = os.stat(abs_path)
+    os.chmod(abs_path,
+             filest.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    if keep_fds is None and not keep_argv:
+        os.execl(abs_path, fname)
+    else:
+        args = [fname] + (sys.argv[1:] if keep_argv else [])
+        os.execve(abs_path, args, _handoff_fds(keep_fds))
+
+
+def _handoff_fds(fds):
+    """
+    Moves **fds**, a list of sockets or file descriptors or a dict mapping
+    names to them, to consecutive inheritable file descriptors starting at
+    3 and returns the environment that describes them to the next process.
+    """
+    env = dict(os.environ)
+    for name in ('LISTEN_FDS', 'LISTEN_PID', 'LISTEN_FDNAMES'):
+        env.pop(name, None)
+    if not fds:
+        return env
+
+    if isinstance(fds, dict):
+        names, fds = list(fds), list(fds.values())
+    else:
+        names, fds = ['unknown'] * len(fds), list(fds)
+    for name in names:
+        if not name or ':' in name:
+            raise ValueError("Invalid file descriptor name {!r}".format(name))
+    fds = [item if isinstance(item, int) else item.fileno() for item in fds]
+
+    # Duplicate everything above the target range first so moving one
+    # descriptor into place can't close another one not yet moved.
+    floor = max(fds + [_LISTEN_FDS_START + len(fds)]) + 1
+    moved = [fcntl.fcntl(fileno, fcntl.F_DUPFD, floor) for fileno in fds]
+    for index, fileno in enumerate(moved):
+        os.dup2(fileno, _LISTEN_FDS_START + index, inheritable=True)
+        os.close(fileno)
+
+    env['LISTEN_FDS'] = str(len(fds))
+    env['LISTEN_PID'] = str(os.getpid())
+    env['LISTEN_FDNAMES'] = ':'.join(names)
+    return env
+
+
+def listen_fds(unset_environment=True):
+    """
+    Returns the file descriptors handed over to this process by
+    :func:`~keepitfresh.overwrite_restart` with **keep_fds**, or by systemd
+    socket activation, as a list of ``(name, fd)`` tuples in the order they
+    were passed. Names are ``'unknown'`` when none were given. Returns an
+    empty list if nothing was handed over to this process.
+
+    The file descriptors are marked non-inheritable and, if
+    **unset_environment** is ``True``, the variables describing them are
+    removed from the environment so child processes don't pick them up.
+    Wrap them with ``socket.socket(fileno=fd)`` to use them as sockets.
+    """
+    try:
+        pid = int(os.environ.get('LISTEN_PID', ''))
+        count = int(os.environ.get('LISTEN_FDS', ''))
+    except ValueError:
+        return []
+    names = os.environ.get('LISTEN_FDNAMES')
+    if unset_environment:
+        for name in ('LISTEN_FDS', 'LISTEN_PID', 'LISTEN_FDNAMES'):
+            os.environ.pop(name, None)
+    if pid != os.getpid() or count <= 0:
+        return []
+
+    names = names.split(':') if names else []
+    names += ['unknown'] * (count - len(names))
+    fds = []
+    for index in range(count):
+        fileno = _LISTEN_FDS_START + index
+        os.set_inheritable(fileno, False)
+        fds.append((names[index], fileno))
+    return fds
+
+
+def _remove_item(path):
+    """
+    Removes the file or folder in **path**.
+    """
+    from shutil import rmtree
+    if os.path.isdir(path) and not os.path.islink(path):
+        rmtree(path)
+    else:
+        os.remove(path)
+
+
+def _swap(initem, owitem):
+    """
+    Replaces **owitem** with **initem** (renamed to keep its own name) using
+    renames within the parent folder of **owitem**.
+
+    Only a file replacing a file of the same name is swapped atomically.
+    Folders take two renames, moving **owitem** aside and then **initem**
+    into place, with nothing at the path in between; **owitem** is moved
+    back if the second rename fails.
+    """
+    from shutil import copy2, copytree
+    owdir = os.path.dirname(owitem)
+    dest = os.path.join(owdir, os.path.basename(initem))
+    staged = os.path.join(owdir, '.{}.keepitfresh-new'.format(
+        os.path.basename(initem)))
+    backup = os.path.join(owdir, '.{}.keepitfresh-old'.format(
+        os.path.basename(owitem)))
+    for leftover in (staged, backup):
+        if os.path.lexists(leftover):
+            _remove_item(leftover)
+
+    try:
+        os.rename(initem, staged)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        if os.path.isdir(initem):
+            copytree(initem, staged, symlinks=True)
+        else:
+            copy2(initem, staged)
+
+    if dest == owitem and not (os.path.isdir(owitem) or
+                               os.path.isdir(staged)):
+        os.replace(staged, dest)
+        return
+
+    os.rename(owitem, backup)
+    try:
+        os.rename(staged, dest)
+    except OSError:
+        os.rename(backup, owitem)
+        raise
+    _remove_item(backup)
+
+
+def _file_digest(path):
+    """
+    Returns the hex sha256 digest of the file in **path**.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as in_file:
+        for chunk in iter(partial(in_file.read, _CHUNK_SIZE * 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _scan_tree(root, previous=None):
+    """
+    Returns the manifest of the folder **root**, mapping the relative path of
+    each file to its ``[size, mtime_ns, mode, sha256]``.
+
+    Symbolic links, including links to folders, are not followed; their
+    ``sha256`` is replaced by ``"link:"`` and the path they point to.
+    Hashes are only copied over from the **previous** manifest when the file
+    did not change size or modification time since, otherwise they are left
+    as ``None`` to be computed when needed.
+    """
+    previous = previous or {}
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        links = [name for name in dirnames
+                 if os.path.islink(os.path.join(dirpath, name))]
+        for name in links:
+            dirnames.remove(name)
+        for filename in filenames + links:
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, root).replace(os.path.sep, '/')
+            file_st = os.lstat(path)
+            entry = [file_st.st_size, file_st.st_mtime_ns,
+                     stat.S_IMODE(file_st.st_mode), None]
+            old = previous.get(relpath)
+            if stat.S_ISLNK(file_st.st_mode):
+                entry[3] = _LINK_PREFIX + os.readlink(path)
+            elif old is not None and old[:2] == entry[:2] and not (
+                    old[3] or '').startswith(_LINK_PREFIX):
+                entry[3] = old[3]
+            manifest[relpath] = entry
+    return manifest
+
+
+def _scan_dirs(root):
+    """
+    Returns the relative paths of the folders under **root**, not counting
+    symbolic links to folders, parents first.
+    """
+    found = []
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames[:] = [name for name in dirnames
+                       if not os.path.islink(os.path.join(dirpath, name))]
+        found.extend(os.path.relpath(os.path.join(dirpath, name), root)
+                     for name in dirnames)
+    return found
+
+
+def _same_entry(old, entry, target, source):
+    """
+    Tells whether the installed **target**, described by the manifest entry
+    **old**, has the same contents as the incoming **source** described by
+    **entry**, hashing them if needed.
+    """
+    if old is None or old[0] != entry[0]:
+        return False
+    if (old[3] or '').startswith(_LINK_PREFIX) or (
+            entry[3] or '').startswith(_LINK_PREFIX):
+        return old[3] == entry[3]
+    if old[3] is None:
+        old[3] = _file_digest(target)
+    if entry[3] is None:
+        entry[3] = _file_digest(source)
+    return old[3] == entry[3]
+
+
+def _move_in(owitem, staging, backup, *, changed, chmods, removed, dirs):
+    """
+    Moves the **changed** files copied to **staging** into **owitem**,
+    setting what they replace aside in **backup** together with the
+    **removed** files and the folders that are not in **dirs**, then applies
+    the mode changes in **chmods**. Everything is put back as it was if
+    this fails.
+    """
+    from shutil import rmtree
+    os.mkdir(backup)
+    journal = []
+
+    def set_aside(target):
+        kept = os.path.join(backup, str(len(journal)))
+        os.rename(target, kept)
+        journal.append((os.rename, kept, target))
+
+    try:
+        keep_dirs = set(dirs)
+        for relpath in _scan_dirs(owitem):
+            target = os.path.join(owitem, relpath)
+            if relpath not in keep_dirs and os.path.isdir(target):
+                set_aside(target)
+        for relpath in sorted(changed + removed):
+            target = os.path.join(owitem, relpath)
+            if os.path.lexists(target):
+                set_aside(target)
+        for relpath in dirs:
+            target = os.path.join(owitem, relpath)
+            if not os.path.isdir(target):
+                os.mkdir(target)
+                journal.append((os.rmdir, target))
+        for index, relpath in enumerate(changed):
+            target = os.path.join(owitem, relpath)
+            os.rename(os.path.join(staging, str(index)), target)
+            journal.append((os.remove, target))
+        for target, old_mode, mode in chmods:
+            os.chmod(target, mode)
+            journal.append((os.chmod, target, old_mode))
+    except BaseException:
+        for undo in reversed(journal):
+            undo[0](*undo[1:])
+        rmtree(backup)
+        raise
+    rmtree(backup)
+
+
+def _apply_incremental(initem, owitem):
+    """
+    Updates the folder **owitem** in place so it matches the folder
+    **initem**, then renames it after **initem**.
+
+    The changed files are first copied next to **owitem**, so a failure
+    while copying leaves **owitem** untouched. They are then moved in,
+    keeping what they replace aside until the end so that **owitem** is
+    restored if a move fails.
+    """
+    from shutil import copy2, rmtree
+    owdir = os.path.dirname(owitem)
+    name = os.path.basename(owitem)
+    dest = os.path.join(owdir, os.path.basename(initem))
+    manifest_path = os.path.join(owdir, '.{}.keepitfresh-manifest'.format(
+        name))
+    staging = os.path.join(owdir, '.{}.keepitfresh-new'.format(name))
+    backup = os.path.join(owdir, '.{}.keepitfresh-old'.format(name))
+    for leftover in (staging, backup):
+        if os.path.lexists(leftover):
+            _remove_item(leftover)
+
+    installed = _scan_tree(owitem, _read_state(manifest_path))
+    incoming = _scan_tree(initem)
+
+    changed = []
+    chmods = []
+    for relpath, entry in sorted(incoming.items()):
+        old = installed.get(relpath)
+        target = os.path.join(owitem, relpath)
+        source = os.path.join(initem, relpath)
+        if not _same_entry(old, entry, target, source):
+            changed.append(relpath)
+        elif old[2] != entry[2] and not os.path.islink(source):
+            chmods.append((target, old[2], entry[2]))
+
+    os.mkdir(staging)
+    try:
+        for index, relpath in enumerate(changed):
+            copy2(os.path.join(initem, relpath),
+                  os.path.join(staging, str(index)), follow_symlinks=False)
+        _move_in(owitem, staging, backup, changed=changed, chmods=chmods,
+                 removed=[relpath for relpath in installed
+                          if relpath not in incoming],
+                 dirs=_scan_dirs(initem))
+    finally:
+        rmtree(staging, ignore_errors=True)
+
+    manifest = _scan_tree(owitem)
+    for relpath, entry in manifest.items():
+        entry[3] = incoming[relpath][3]
+    if dest != owitem:
+        os.rename(owitem, dest)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        manifest_path = os.path.join(owdir, '.{}.keepitfresh-manifest'.format(
+            os.path.basename(dest)))
+    _write_state(manifest_path, manifest)
+
+
+class VersionStore:
+    """
+    Keeps every installed version of an application side by side so that
+    switching between them is instant, as an alternative to replacing the
+    application with :func:`~keepitfresh.overwrite_restart`.
+
+    Each version is installed in its own ``versions/<version>`` folder below
+    **root** and the ``current`` symlink in **root** points to the one in
+    use, so the application is always started through ``<root>/current``.
+    Files identical to the ones of an installed version, in content and
+    permissions, are hardlinked instead of copied, so installed files must
+    never be modified in place.
+
+    :meth:`prune` keeps the newest **keep** versions, compared with
+    **versioncmp** as in :func:`~keepitfresh.get_update_version`, as well as
+    the current and previous ones. Symlinks are required, which on Windows
+    means administrator rights or Developer Mode.
+    """
+
+    def __init__(self, root, keep=3, versioncmp=None):
+        self.root = os.path.abspath(root)
+        self.keep = keep
+        self.versioncmp = versioncmp
+
+    @property
+    def current(self):
+        """
+        The version in use, ``None`` if none was activated yet.
+        """
+        try:
+            return os.path.basename(os.readlink(
+                os.path.join(self.root, _STORE_CURRENT)))
+        except OSError:
+            return None
+
+    @property
+    def previous(self):
+        """
+        The installed version that was in use before the current one, which
+        :meth:`rollback` switches back to, ``None`` if there is none.
+        """
+        current = self.current
+        for version in reversed(self._history()):
+            if version != current and os.path.isdir(self.path(version)):
+                return version
+        return None
+
+    def versions(self):
+        """
+        Returns the installed versions, from the oldest to the newest.
+        """
+        try:
+            names = os.listdir(os.path.join(self.root, _STORE_VERSIONS))
+        except OSError:
+            return []
+        return sorted((name for name in names if not name.startswith('.')),
+                      key=_version_key(self.versioncmp))
+
+    def path(self, version=None):
+        """
+        Returns the folder of **version**, or the ``current`` symlink if it
+        is ``None``.
+        """
+        if version is None:
+            return os.path.join(self.root, _STORE_CURRENT)
+        return os.path.join(self.root, _STORE_VERSIONS, version)
+
+    def install(self, item, version):
+        """
+        Copies the application file or folder **item** into the store as
+        **version**, without activating it, and returns the path of the
+        copy. Nothing is copied if **version** is already installed.
+        """
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        if not version or version.startswith('.') or (
+                os.path.basename(version) != version):
+            raise ValueError("Invalid version {!r}".format(version))
+        item = os.path.abspath(item)
+        dest = os.path.join(self.path(version), os.path.basename(item))
+        if os.path.isdir(self.path(version)):
+            return dest
+
+        versions_dir = os.path.join(self.root, _STORE_VERSIONS)
+        os.makedirs(versions_dir, exist_ok=True)
+        tmpdir = mkdtemp(prefix='.', dir=versions_dir)
+        try:
+            digests = self._copy(item, os.path.join(
+                tmpdir, os.path.basename(item)), tmpdir)
+            manifest = _scan_tree(tmpdir)
+            for relpath, entry in manifest.items():
+                entry[3] = digests.get(relpath, entry[3])
+            _write_state(self._manifest_path(version), manifest)
+            os.rename(tmpdir, self.path(version))
+        except BaseException:
+            rmtree(tmpdir, ignore_errors=True)
+            raise
+        return dest
+
+    def activate(self, version):
+        """
+        Atomically points the ``current`` symlink to the installed
+        **version**.
+        """
+        self._switch(version, self._history())
+
+    def rollback(self):
+        """
+        Switches back to the previous version and returns it. The version
+        rolled back from is left installed but is no longer a candidate for
+        the next rollback. Raises a :exc:`ValueError` if there is no
+        previous version.
+        """
+        previous = self.previous
+        if previous is None:
+            raise ValueError("No version to roll back to")
+        current = self.current
+        self._switch(previous, [version for version in self._history()
+                                if version != current])
+        return previous
+
+    def prune(self, keep=None):
+        """
+        Removes the installed versions other than the newest **keep** ones,
+        which defaults to the **keep** the store was created with, and the
+        current and previous ones. Returns the removed versions.
+        """
+        from shutil import rmtree
+        keep = self.keep if keep is None else keep
+        versions = self.versions()
+        protected = {self.current, self.previous}
+        protected.update(versions[len(versions) - keep:] if keep else ())
+        removed = []
+        for version in versions:
+            if version in protected:
+                continue
+            rmtree(self.path(version))
+            if os.path.exists(self._manifest_path(version)):
+                os.remove(self._manifest_path(version))
+            removed.append(version)
+        return removed
+
+    def restart(self, entry_point, keep_fds=None, keep_argv=False):
+        """
+        Restarts the process with **entry_point**, the relative path from
+        ``<root>/current`` to the executable, as
+        :func:`~keepitfresh.overwrite_restart` does.
+        """
+        _restart(os.path.join(self.path(), entry_point), keep_fds, keep_argv)
+
+    def _history(self):
+        state = _read_state(os.path.join(self.root, _STORE_STATE)) or {}
+        return state.get('history', [])
+
+    def _switch(self, version, history):
+        if not os.path.isdir(self.path(version)):
+            raise ValueError("Version {} is not installed".format(version))
+        link = self.path()
+        tmp_link = os.path.join(self.root, '.{}.keepitfresh-new'.format(
+            _STORE_CURRENT))
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.join(_STORE_VERSIONS, version), tmp_link,
+                   target_is_directory=True)
+        os.replace(tmp_link, link)
+
+        installed = set(self.versions())
+        history = [old for old in history
+                   if old != version and old in installed] + [version]
+        _write_state(os.path.join(self.root, _STORE_STATE),
+                     {'history': history})
+
+    def _manifest_path(self, version):
+        return os.path.join(self.root, _STORE_VERSIONS,
+                            '.{}.keepitfresh-manifest'.format(version))
+
+    def _copy(self, item, dest, root):
+        """
+        Copies **item** to **dest**, hardlinking the files that are the
+        same in an installed version, and returns the digests computed on
+        the way by path relative to **root**.
+        """
+        from shutil import copy2, copytree
+        versions = self.versions()[::-1]
+        if self.current in versions:
+            versions.remove(self.current)
+            versions.insert(0, self.current)
+        installed = [(self.path(version), _scan_tree(
+            self.path(version), _read_state(self._manifest_path(version))))
+            for version in versions]
+        digests = {}
+
+        def link_or_copy(source, target):
+            relpath = os.path.relpath(target, root).replace(os.path.sep, '/')
+            source_st = os.stat(source)
+            for version_dir, manifest in installed:
+                entry = manifest.get(relpath)
+                if entry is None or entry[0] != source_st.st_size or (
+                        entry[2] != stat.S_IMODE(source_st.st_mode)):
+                    continue
+                if entry[3] is None:
+                    entry[3] = _file_digest(os.path.join(version_dir,
+                                                         relpath))
+                if relpath not in digests:
+                    digests[relpath] = _file_digest(source)
+                if entry[3] == digests[relpath]:
+                    try:
+                        os.link(os.path.join(version_dir, relpath), target)
+                        return target
+                    except OSError:
+                        break
+            return copy2(source, target)
+
+        if os.path.isdir(item) and not os.path.islink(item):
+            copytree(item, dest, symlinks=True, copy_function=link_or_copy)
+        elif os.path.islink(item):
+            copy2(item, dest, follow_symlinks=False)
+        else:
+            link_or_copy(item, dest)
+        return digests
+
+
+def get_delta_urls(base_url, regex, cache=None, session=None):
+    """
+    Looks through **base_url** for delta artifacts, much like
+    :func:`~keepitfresh.get_file_urls`, and returns a dictionary of
+    ``(file_url, (from_version, to_version))`` value-pairs.
+
+    The **regex** argument MUST have the version the delta applies to in its
+    first capturing group and the version it produces in the second, for
+    example ``r"b-(\\d+\\.\\d+\\.\\d+)-to-(\\d+\\.\\d+\\.\\d+)\\.zip"``.
+    See :func:`~keepitfresh.apply_delta` for the format of delta artifacts.
+    A delta for a single file application needs a ``<delta>.sha256`` file
+    next to it, in the format of ``sha256sum``, with the digest of the file
+    it produces.
+    """
+    pattern = _compile_file_regex(regex)
+    delta_dict = {}
+    file_urls = get_file_urls(base_url, '(' + regex + ')', cache, session)
+    for url, name in file_urls.items():
+        delta_dict[url] = pattern.match(name).group(1, 2)
+    return delta_dict
+
+
+def find_delta_chain(delta_dict, current_version, target_version, vcmp=None,
+                     sizes=None):
+    """
+    Finds the cheapest chain of deltas in **delta_dict**, as returned by
+    :func:`~keepitfresh.get_delta_urls`, that updates **current_version** to
+    **target_version**.
+
+    **sizes** optionally maps delta urls to their size in bytes, in which
+    case the chain with the fewest bytes to download wins, deltas of
+    unknown size counting as the largest known one. Otherwise the chain
+    with the fewest deltas wins.
+
+    Returns the list of delta urls to apply in order, or an empty list if
+    the deltas don't connect both versions. **vcmp** works as in
+    :func:`~keepitfresh.get_update_version`.
+    """
+    def normalize(version):
+        return version if vcmp is not None else _parse_version(version)
+
+    known = [size for size in (sizes or {}).values() if size is not None]
+    default = max(known, default=1)
+    edges = {}
+    for url, (from_version, to_version) in delta_dict.items():
+        if _is_newer(from_version, to_version, vcmp):
+            cost = 1
+            if sizes is not None:
+                cost = sizes.get(url)
+                cost = default if cost is None else cost
+            edges.setdefault(normalize(from_version), []).append(
+                (url, normalize(to_version), cost))
+
+    start = normalize(current_version)
+    target = normalize(target_version)
+    costs = {start: 0}
+    chains = {start: []}
+    # Numbering the pushes keeps versions, which may not be comparable, out
+    # of the heap comparisons.
+    pushed = 0
+    pending = [(0, pushed, start)]
+    while pending:
+        cost, _, version = heappop(pending)
+        if version == target:
+            return chains[version]
+        if cost > costs[version]:
+            continue
+        for url, next_version, edge_cost in edges.get(version, ()):
+            next_cost = cost + edge_cost
+            if next_cost < costs.get(next_version, next_cost + 1):
+                costs[next_version] = next_cost
+                chains[next_version] = chains[version] + [url]
+                pushed += 1
+                heappush(pending, (next_cost, pushed, next_version))
+    return []
+
+
+def _content_length(url, session=None):
+    """
+    Returns the size of **url** according to a ``HEAD`` request, or
+    ``None`` if the server does not tell or refuses the request.
+    """
+    try:
+        with _urlopen(url, method='HEAD', session=session) as head:
+            length = head.headers.get('Content-Length')
+        return int(length) if length else None
+    except (OSError, ValueError):
+        return None
+
+
+def _delta_sizes(delta_dict, current_version, target_version, vcmp=None, *,
+                 session=None):
+    """
+    Returns the sizes of the deltas in **delta_dict** that may be part of a
+    chain from **current_version** to **target_version**, for
+    :func:`~keepitfresh.find_delta_chain`.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    urls = [url for url, (from_version, to_version) in delta_dict.items()
+            if not _is_newer(from_version, current_version, vcmp) and not (
+                _is_newer(target_version, to_version, vcmp))]
+    if not urls:
+        return {}
+    with ThreadPoolExecutor(min(len(urls), 8)) as executor:
+        sizes = executor.map(partial(_content_length, session=session), urls)
+        return {url: size for url, size in zip(urls, sizes)
+                if size is not None}
+
+
+def _offtin(data, offset):
+    """
+    Reads the signed 64 bit integer bsdiff stores at **offset** of **data**.
+    """
+    value = int.from_bytes(data[offset:offset + 8], 'little')
+    if value & 1 << 63:
+        return -(value & ~(1 << 63))
+    return value
+
+
+def _add_bytes(first, second):
+    """
+    Adds two equally long byte strings byte by byte, modulo 256.
+    """
+    size = len(first)
+    low = int.from_bytes(b'\x7f' * size, 'little')
+    high = int.from_bytes(b'\x80' * size, 'little')
+    first = int.from_bytes(first, 'little')
+    second = int.from_bytes(second, 'little')
+    total = ((first & low) + (second & low)) ^ ((first ^ second) & high)
+    return total.to_bytes(size, 'little')
+
+
+def _bspatch(old, patch):
+    """
+    Applies the bsdiff (``BSDIFF40``) **patch** to the bytes in **old** and
+    returns the new bytes.
+    """
+    import bz2
+    if patch[:8] != b'BSDIFF40' or len(patch) < 32:
+        raise ValueError("Not a bsdiff patch")
+    ctrl_len = _offtin(patch, 8)
+    diff_len = _offtin(patch, 16)
+    new_size = _offtin(patch, 24)
+    if ctrl_len < 0 or diff_len < 0 or new_size < 0:
+        raise ValueError("Corrupt bsdiff patch")
+    ctrl = bz2.decompress(patch[32:32 + ctrl_len])
+    diff = bz2.decompress(patch[32 + ctrl_len:32 + ctrl_len + diff_len])
+    extra = bz2.decompress(patch[32 + ctrl_len + diff_len:])
+
+    new = bytearray()
+    old_pos = diff_pos = extra_pos = 0
+    for ctrl_pos in range(0, len(ctrl) - 23, 24):
+        add_len = _offtin(ctrl, ctrl_pos)
+        copy_len = _offtin(ctrl, ctrl_pos + 8)
+        seek = _offtin(ctrl, ctrl_pos + 16)
+        if add_len < 0 or copy_len < 0 or (
+                len(new) + add_len + copy_len > new_size):
+            raise ValueError("Corrupt bsdiff patch")
+
+        start = max(old_pos, 0)
+        end = min(old_pos + add_len, len(old))
+        if start < end:
+            base = (bytes(start - old_pos) + old[start:end] +
+                    bytes(old_pos + add_len - end))
+        else:
+            base = bytes(add_len)
+        new += _add_bytes(diff[diff_pos:diff_pos + add_len], base)
+        new += extra[extra_pos:extra_pos + copy_len]
+        diff_pos += add_len
+        extra_pos += copy_len
+        old_pos += add_len + seek
+
+    if len(new) != new_size:
+        raise ValueError("Corrupt bsdiff patch")
+    return bytes(new)
+
+
+def _patch_file(path, patch_path, digest):
     """
-    Inspired by uscan, the debian packaging utility.
+    Replaces the file in **path** with the result of applying the bsdiff
+    patch in **patch_path** to it, without modifying the original file.
+    Raises a :exc:`ValueError` if the result does not have the hex sha256
+    **digest**.
+    """
+    from shutil import copystat
+    with open(path, 'rb') as old_file, open(patch_path, 'rb') as patch_file:
+        new = _bspatch(old_file.read(), patch_file.read())
+    if hashlib.sha256(new).hexdigest() != digest.lower():
+        raise ValueError("Delta result {} does not match its digest".format(
+            path))
+    tmp_path = os.path.join(os.path.dirname(path),
+                            '.{}.keepitfresh-tmp'.format(
+                                os.path.basename(path)))
+    with open(tmp_path, 'wb') as new_file:
+        new_file.write(new)
+    copystat(path, tmp_path)
+    os.replace(tmp_path, path)
 
-    Looks through all ``<a href="*">`` references to files in the given
-    base url and extracts them into a dictionary of (file_url, file_version)
-    value-pairs.
 
-    The **regex** argument is a regular expression that matches the file name.
-    It MUST have the file's version in a capturing group and this MUST be the
-    first group (``\\1`` backreference).
+def _inside(root, relpath):
+    """
+    Returns the path of **relpath** in **root**, refusing paths outside it.
+    """
+    root = os.path.abspath(root)
+    path = os.path.abspath(os.path.join(root, relpath))
+    if os.path.commonpath([root, path]) != root or path == root:
+        raise ValueError("Path {} is outside of {}".format(relpath, root))
+    return path
 
-    As an example, consider a project named *b* by *a* which deploys
-    to Github Releases with filenames such as *b-1.0.0.zip*. The function
-    call would look like::
 
-        >>> base_url = "https://github.com/a/b/releases"
-        >>> regex = r"b-(\\d+\\.\\d+\\.\\d+)\\.zip"
-        >>> result = get_file_urls(base_url, regex)
-        >>> result
-        {"https://github.com/a/b/releases/download/1.0.0/b-1.0.0.zip": "1.0.0"}
+def apply_delta(delta_path, item, sha256=None):
+    """
+    Applies the delta artifact in **delta_path** to the application
+    file/folder **item**, in place. Every file is rewritten through a new
+    file, so files hardlinked elsewhere are never modified.
+
+    If **item** is a file, the delta is a
+    `bsdiff <http://www.daemonology.net/bsdiff/>`_ patch for it and
+    **sha256** is the hex digest the patched file must have.
+
+    If **item** is a folder, the delta is an archive that
+    :func:`~keepitfresh.unpack_archive` can unpack, where each member
+    ending in ``.bsdiff`` is a patch for the file of the same path without
+    that suffix and every other member is a file to add or replace. A
+    ``.keepitfresh-delta.json`` member holds a ``"sha256"`` mapping of paths
+    to the hex digests they must have once the delta is applied, with an
+    entry for every file the delta patches or adds, and an optional
+    ``"removed"`` list of paths to delete.
+
+    A :class:`ValueError` is raised if a digest is missing or does not
+    match.
     """
-    with urlopen(base_url) as web:
-        content = web.read().decode(web.headers.get_content_charset())
+    from shutil import copy2
+    from tempfile import TemporaryDirectory
+    if not os.path.isdir(item):
+        if sha256 is None:
+            raise ValueError("No digest for the result of {}".format(
+                delta_path))
+        _patch_file(item, delta_path, sha256)
+        return
 
-    pattern = r'<\s*a\s+[^>]*href\s*=\s*[\"\'](.*?' + regex + r')[\"\']'
-    results = findall(pattern, content)
+    with TemporaryDirectory() as tmpdir:
+        unpack_archive(delta_path, tmpdir)
+        info = _read_state(os.path.join(tmpdir, _DELTA_INFO)) or {}
+        digests = info.get('sha256', {})
+        members = []
+        for dirpath, _, filenames in os.walk(tmpdir):
+            for filename in filenames:
+                source = os.path.join(dirpath, filename)
+                relpath = os.path.relpath(source, tmpdir)
+                if relpath == _DELTA_INFO:
+                    continue
+                if relpath.endswith(_DELTA_SUFFIX):
+                    relpath = relpath[:-len(_DELTA_SUFFIX)]
+                relpath = relpath.replace(os.path.sep, '/')
+                if relpath not in digests:
+                    raise ValueError("No digest for delta result {}".format(
+                        relpath))
+                members.append((source, relpath))
 
-    file_dict = {}
-    for match in results:
-        file_dict[urljoin(base_url, match[0])] = match[1]
+        for source, relpath in members:
+            target = _inside(item, relpath)
+            if source.endswith(_DELTA_SUFFIX):
+                _patch_file(target, source, digests[relpath])
+                continue
+            if _file_digest(source) != digests[relpath].lower():
+                raise ValueError("Delta result {} does not match its "
+                                 "digest".format(relpath))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp_path = os.path.join(
+                os.path.dirname(target),
+                '.{}.keepitfresh-tmp'.format(os.path.basename(target)))
+            copy2(source, tmp_path)
+            os.replace(tmp_path, target)
 
-    return file_dict
+    for relpath in info.get('removed', []):
+        target = _inside(item, relpath)
+        if os.path.lexists(target):
+            _remove_item(target)
+    for relpath, digest in digests.items():
+        target = _inside(item, relpath)
+        if not os.path.isfile(target) or _file_digest(target) != (
+                digest.lower()):
+            raise ValueError("Delta result {} does not match its "
+                             "digest".format(relpath))
 
 
-def get_update_version(file_dict, current_version, vcmp=None):
+def _delta_digest(url, session=None):
     """
-    Look through a dictionary that maps file urls to version strings, much like
-    the one returned by :func:`~keepitfresh.get_file_urls`, and get the latest
-    version and corresponding file url. If no version newer than
-    **current_version** is found, returns an empty tuple.
+    Returns the hex sha256 digest of the file the single file delta **url**
+    produces, read from the ``<url>.sha256`` file next to it, written in
+    one of the formats :func:`~keepitfresh.get_checksums` understands.
+    """
+    with _urlopen(url + '.sha256', session=session) as response:
+        text = response.read().decode('utf8', 'replace')
+    for line in text.splitlines():
+        match = _CHECKSUM_RE.match(line) or _BSD_CHECKSUM_RE.match(line)
+        if match:
+            return match.group('digest').lower()
+    raise ValueError("No digest for the result of {}".format(url))
 
-    **current_version** should be a string in the same pattern as used in
-    :func:`~keepitfresh.get_file_urls`.
 
-    To get the latest version, a comparison function is used. The default uses
-    the comparison from the
-    `packaging <https://packaging.pypa.io/en/latest/version/>`_ package. To
-    override this, pass a function in **vcmp** that accepts two version strings
-    and returns ``True`` whenever the second version string is newer than the
-    first version string.
+def _link_or_copy(source, dest):
+    """
+    Hardlinks **source** to **dest**, copying it if that is not possible.
     """
-    freshest_match = (None, current_version)
+    from shutil import copy2
+    try:
+        os.link(source, dest)
+    except OSError:
+        copy2(source, dest)
 
-    for url, version in file_dict.items():
-        fresher = False
 
-        if vcmp is not None:
-            fresher = vcmp(freshest_match[1], version)
-        else:
-            fresher = parse(freshest_match[1]) < parse(version)
+def _stage_deltas(delta_urls, overwrite_item, outdir, *, checksums=None,
+                  hash_name='sha256', verify=None, tracer=None, session=None):
+    """
+    Builds the updated application in **outdir** by applying the deltas in
+    **delta_urls** to a hardlinked copy of **overwrite_item** and returns
+    its path. Each delta is verified as in :func:`~keepitfresh.dl_unpack`,
+    against its entry in **checksums** if passed, and so is its result, see
+    :func:`~keepitfresh.apply_delta`.
+    """
+    with _Span(tracer, 'delta', files=len(delta_urls)):
+        return _apply_deltas(delta_urls, overwrite_item, outdir,
+                             checksums=checksums, hash_name=hash_name,
+                             verify=verify, session=session)
 
-        if fresher:
-            freshest_match = (url, version)
 
-    if freshest_match == (None, current_version):
-        return ()
-    return freshest_match
+def _apply_deltas(delta_urls, overwrite_item, outdir, *, checksums,
+                  hash_name, verify, session):
+    """
+    Does the work of :func:`_stage_deltas`.
+    """
+    from shutil import copytree
+    from tempfile import TemporaryDirectory
+    stage = os.path.join(outdir, os.path.basename(overwrite_item))
+    if os.path.isdir(overwrite_item):
+        copytree(overwrite_item, stage, symlinks=True,
+                 copy_function=_link_or_copy)
+    else:
+        _link_or_copy(overwrite_item, stage)
+
+    with TemporaryDirectory() as tmpdir:
+        for index, url in enumerate(delta_urls):
+            delta_path = os.path.join(tmpdir, '{}-{}'.format(
+                index, url.rsplit('/', 1)[1]))
+            hasher = checksum = None
+            if checksums is not None or verify is not None:
+                hasher = hashlib.new(hash_name)
+            if checksums is not None:
+                checksum = checksums.get(url.rsplit('/', 1)[1])
+                if checksum is None:
+                    raise IntegrityError("No checksum for {}".format(url))
+            _download(url, delta_path, hasher=hasher, session=session)
+            _check_integrity(url, hasher, checksum, verify)
+            digest = None
+            if not os.path.isdir(stage):
+                digest = _delta_digest(url, session)
+            apply_delta(delta_path, stage, digest)
+    return stage
 
 
-def dl_unpack(url, outdir, unpack=None):
+def is_fresh(base_url, regex, current_version, versioncmp=None, *,
+             cache=None, max_pages=1, prereleases=True, tracer=None,
+             session=None):
     """
-    Downloads the archive in **url** and unpacks it to **outdir**.
+    Checks whether your application is fresh (if there is a more
+    recent version).
+    Returns False if there is a newer version, True otherwise.
+
+    No more pages are fetched once a newer version is found or once the
+    listing has gone past **current_version**.
 
-    Unpacking is handled by `patool <http://wummel.github.io/patool/>`_.
-    If you need to override this, you can a function in **unpack** that
-    accepts the archive path as the first argument and the output folder
-    as the second argument.
+    For what each argument means, please refer to
+    :func:`~keepitfresh.freshen_up`.
     """
-    fname = url.rsplit('/', 1)[1]
-    with TemporaryDirectory() as tmpdir:
-        file_path = os.path.join(tmpdir, fname)
-        with urlopen(url) as response, open(file_path, 'wb') as out_file:
-            copyfileobj(response, out_file)
+    file_urls = iter_file_urls(base_url, regex, current_version, versioncmp,
+                               max_pages=max_pages, cache=cache,
+                               tracer=tracer, session=session)
+    for _, version in _filter_versions(file_urls, prereleases):
+        if _is_newer(current_version, version, versioncmp):
+            return False
+    return True
 
-        if unpack is not None:
-            unpack(file_path, outdir)
-        else:
-            extract_archive(file_path, outdir=outdir, verbosity=-1)
 
+def _check_page(file_dict, current_version, vcmp, prereleases):
+    """
+    Checks a single page of a listing against **current_version**.
 
-def overwrite_restart(initem, owitem, entry_point):
+    Returns ``False`` if there is a newer version, ``True`` if the listing
+    has gone past **current_version** and ``None`` if the next page needs
+    to be checked.
     """
-    Overwrites the current application file/folder and restarts the process
-    with the updated application.
+    if rank_versions(file_dict, current_version, vcmp, prereleases, limit=1):
+        return False
+    return True if _has_passed(file_dict, current_version, vcmp) else None
 
-    Inspired by PyUpdater, uses a separate process for Unix and Windows
-    (Windows does not allow file deletion while it's still being used so we
-    have to work around that).
 
-    **initem** can be either a file or a folder and is the path to the updated
-    application. **owitem** can be either a file or a folder and is the path
-    to the old application.
+def _check_group(base_url, specs, *, vcmp, cache, max_pages, prereleases,
+                 session=None):
+    """
+    Checks all **specs** that share **base_url**, fetching and scanning each
+    page of the listing only once for all of them.
 
-    **entry_point** is the relative path from the parent folder of **owitem**
-    to the executable to restart with.
+    Returns a list of ``(spec, result)`` pairs.
     """
-    initem = os.path.abspath(initem)
-    owitem = os.path.abspath(owitem)
-    owdir = os.path.dirname(owitem)
-    abs_path = os.path.join(owdir, entry_point)
-    fname = os.path.basename(abs_path)
+    results = []
+    pending = list(specs)
+    url = base_url
+    visited = set()
+    while pending and url is not None and url not in visited:
+        if max_pages is not None and len(visited) >= max_pages:
+            break
+        visited.add(url)
+        regexes = tuple(OrderedDict.fromkeys(spec[1] for spec in pending))
+        try:
+            file_dicts, url = _get_page(url, regexes, cache, session=session)
+        except Exception as exc:  # pylint: disable=broad-except
+            results.extend((spec, exc) for spec in pending)
+            return results
+        file_dicts = dict(zip(regexes, file_dicts))
 
-    if system() == 'Windows':  # pragma: no unix
-        vbs_string = ('CreateObject("Wscript.Shell").Run """" '
-                      '& WScript.Arguments(0) & """", 0, False')
+        still_pending = []
+        for spec in pending:
+            try:
+                result = _check_page(file_dicts[spec[1]], spec[2], vcmp,
+                                     prereleases)
+            except Exception as exc:  # pylint: disable=broad-except
+                result = exc
+            if result is None:
+                still_pending.append(spec)
+            else:
+                results.append((spec, result))
+        pending = still_pending
 
-        bat_string = "@echo off\n"
+    results.extend((spec, True) for spec in pending)
+    return results
 
-        if os.path.isdir(owitem):
-            bat_string += "rd /s /q \"{}\"\n".format(owitem)
-        else:
-            bat_string += "del /q \"{}\"\n".format(owitem)
 
-        if os.path.isdir(initem):
-            dest = os.path.join(owdir, os.path.basename(initem))
-            bat_string += "robocopy \"{}\" \"{}\" /e\n".format(initem, dest)
-        else:
-            bat_string += "copy /y /b \"{}\" \"{}\"\n".format(initem, owdir)
+def find_update(base_url, regex, current_version, versioncmp=None, *,
+                cache=None, max_pages=1, prereleases=True, tracer=None,
+                session=None):
+    """
+    The discovery half of :func:`~keepitfresh.freshen_up`: looks through
+    **base_url** for the latest version newer than **current_version** and
+    returns its ``(file_url, file_version)`` pair, or an empty tuple if there
+    is none.
 
-        bat_string += "start \"\" \"{}\"\n".format(abs_path)
+    For what each argument means, please refer to
+    :func:`~keepitfresh.freshen_up`.
+    """
+    file_urls = list(iter_file_urls(base_url, regex, current_version,
+                                    versioncmp, max_pages=max_pages,
+                                    cache=cache, tracer=tracer,
+                                    session=session))
+    with _Span(tracer, 'rank', files=len(file_urls)):
+        return get_update_version(file_urls, current_version, versioncmp,
+                                  prereleases)
 
-        with TemporaryDirectory() as tmpdir:
-            vbs_path = os.path.join(tmpdir, 'invisble.vbs')
-            bat_path = os.path.join(tmpdir, 'restart.bat')
-            with open(vbs_path, 'w', encoding='utf8') as vbs_file:
-                vbs_file.write(vbs_string)
-            with open(bat_path, 'w', encoding='utf8') as bat_file:
-                bat_file.write(bat_string)
 
-            args = ['wscript.exe', vbs_path, bat_path]
-            subprocess.Popen(args)
-            os._exit(0)
+def is_fresh_many(specs, versioncmp=None, *, cache=None, max_pages=1,
+                  prereleases=True, max_workers=8, session=None):
+    """
+    Runs :func:`~keepitfresh.is_fresh` for many applications at once.
 
-    else:  # pragma: no windows
-        if os.path.isdir(owitem):
-            rmtree(owitem)
-        else:
-            os.remove(owitem)
+    **specs** is an iterable of ``(base_url, regex, current_version)`` tuples.
+    Checks run concurrently on up to **max_workers** threads and specs that
+    share a **base_url** are checked together, with each page fetched only
+    once. The remaining arguments are shared by every spec and work as in
+    :func:`~keepitfresh.is_fresh`. Passing a :class:`~keepitfresh.Session`
+    lets checks against the same host share connections.
 
-        if os.path.isdir(initem):
-            copytree(initem, os.path.join(owdir, os.path.basename(initem)))
-        else:
-            copy2(initem, owdir)
+    Yields ``(spec, result)`` pairs as the checks complete, where **result**
+    is the boolean :func:`~keepitfresh.is_fresh` would return or, if the
+    check failed, the raised exception::
 
-        filest = os.stat(abs_path)
-        os.chmod(abs_path,
-                 filest.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-        os.execl(abs_path, fname)
+        >>> for spec, result in is_fresh_many(specs):
+        ...     if isinstance(result, Exception):
+        ...         # check failed
+        ...     elif not result:
+        ...         # update available
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    groups = OrderedDict()
+    for spec in specs:
+        groups.setdefault(spec[0], []).append(spec)
 
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_check_group, base_url, group,
+                                   vcmp=versioncmp, cache=cache,
+                                   max_pages=max_pages,
+                                   prereleases=prereleases, session=session)
+                   for base_url, group in groups.items()]
+        for future in as_completed(futures):
+            for spec, result in future.result():
+                yield spec, result
 
-def is_fresh(base_url, regex, current_version, versioncmp=None):
+
+def race_mirrors(base_urls, func, scores=None, stagger=0.25):
     """
-    Checks whether your application is fresh (if there is a more
-    recent version).
-    Returns False if there is a newer version, True otherwise.
+    Calls **func** with each of the equivalent **base_urls**, happy eyeballs
+    style, and returns the ``(base_url, result)`` pair of the first call
+    that doesn't raise::
 
-    For what each argument means, please refer to
-    :func:`~keepitfresh.freshen_up`.
+        >>> race_mirrors(mirrors, lambda url: find_update(url, regex, "1.0"))
+
+    Calls start **stagger** seconds apart, or as soon as the previous one
+    failed, in the order of their latency in **scores**, a
+    :class:`~keepitfresh.MirrorScores`, which is updated with the time each
+    call took. If every call fails, the last exception is raised.
+
+    Calls run in daemon threads. Once the race is decided, the ones still
+    fetching release pages, as :func:`~keepitfresh.find_update` does, stop
+    at their next chunk; other calls are left to finish in the background.
     """
-    file_dict = get_file_urls(base_url, regex)
-    latest_match = get_update_version(file_dict, current_version, versioncmp)
-    if not latest_match:
-        return True
-    return False
+    if scores is not None:
+        base_urls = scores.rank(base_urls, 'latency')
+    else:
+        base_urls = list(base_urls)
+    if not base_urls:
+        raise ValueError("No mirrors to race")
+
+    results = queue.Queue()
+    lost = threading.Event()
+
+    def attempt(base_url):
+        _RACE.lost = lost
+        clock = time.perf_counter()
+        try:
+            result = func(base_url)
+        except Exception as exc:  # pylint: disable=broad-except
+            if scores is not None and not lost.is_set():
+                scores.record(base_url, failed=True)
+            results.put((base_url, exc, False))
+            return
+        if scores is not None:
+            scores.record(base_url, latency=time.perf_counter() - clock)
+        results.put((base_url, result, True))
+
+    def start(base_url):
+        threading.Thread(target=attempt, args=(base_url,),
+                         daemon=True).start()
+
+    try:
+        start(base_urls[0])
+        started = 1
+        error = None
+        for _ in base_urls:
+            while True:
+                try:
+                    base_url, result, succeeded = results.get(
+                        timeout=stagger if started < len(base_urls) else None)
+                    break
+                except queue.Empty:
+                    start(base_urls[started])
+                    started += 1
+            if succeeded:
+                return base_url, result
+            error = result
+            if started < len(base_urls):
+                start(base_urls[started])
+                started += 1
+    finally:
+        lost.set()
+    raise error
+
+
+def _mirror_urls(url, base_url, mirrors):
+    """
+    Returns the urls **url**, found on **base_url**, would have on each of
+    the equivalent **mirrors**, either below the same folder or, failing
+    that, on the same host.
+    """
+    folder = base_url.rsplit('/', 1)[0] + '/'
+    mirror_urls = []
+    for mirror in mirrors:
+        if url.startswith(folder):
+            mirror_urls.append(mirror.rsplit('/', 1)[0] + '/' +
+                               url[len(folder):])
+        elif _origin(url) == _origin(base_url):
+            mirror_urls.append(_origin(mirror) + url[len(_origin(url)):])
+    return mirror_urls
+
+
+class UpdateChecker:
+    """
+    Checks for updates with :func:`~keepitfresh.find_update` on a daemon
+    thread, so application startup never waits for the network::
+
+        >>> checker = UpdateChecker(base_url, regex, "1.0.0", callback=notify,
+        ...                         state_path="update-check.json")
+        >>> checker.start()
+
+    The first check runs **delay** seconds after :meth:`start` and then every
+    **interval** seconds, spread by a random fraction of up to **jitter** of
+    the interval so that many clients don't check at once. Failed checks are
+    retried after **retry** seconds, doubling up to **interval** with every
+    consecutive failure.
+
+    If a **state_path** is passed, the time of the last successful check is
+    kept there, so restarting the application doesn't check again before
+    the interval has passed.
+
+    Once a newer version is found, checking stops and the
+    ``(file_url, file_version)`` pair is passed to **callback** and set as
+    the result of :attr:`future`, a :class:`concurrent.futures.Future` that
+    is cancelled if the checker is stopped first. The remaining arguments
+    work as in :func:`~keepitfresh.find_update`.
+    """
+    # The schedule and the listing options are kept as attributes.
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, base_url, regex, current_version, callback=None, *,
+                 state_path=None, delay=5, interval=24 * 60 * 60, jitter=0.1,
+                 retry=60, versioncmp=None, cache=None, max_pages=1,
+                 prereleases=True, session=None):
+        from concurrent.futures import Future
+        self.base_url = base_url
+        self.regex = regex
+        self.current_version = current_version
+        self.callback = callback
+        self.state_path = state_path
+        self.delay = delay
+        self.interval = interval
+        self.jitter = jitter
+        self.retry = retry
+        self.versioncmp = versioncmp
+        self.cache = cache
+        self.max_pages = max_pages
+        self.prereleases = prereleases
+        self.session = session
+        self.future = Future()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts checking in the background.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops checking, waiting up to **timeout** seconds for a check in
+        progress to finish.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.future.cancel()
+
+    @property
+    def last_checked(self):
+        """
+        The time of the last successful check, or ``None``.
+        """
+        state = _read_state(self.state_path) if self.state_path else None
+        return (state or {}).get('last_checked')
+
+    def _run(self):
+        last_checked = self.last_checked
+        wait = self.delay
+        if last_checked is not None:
+            wait = max(wait, last_checked + self.interval - time.time())
+        failures = 0
+        while not self._stopped.wait(wait):
+            try:
+                latest_match = find_update(
+                    self.base_url, self.regex, self.current_version,
+                    self.versioncmp, cache=self.cache,
+                    max_pages=self.max_pages, prereleases=self.prereleases,
+                    session=self.session)
+            except Exception:  # pylint: disable=broad-except
+                wait = min(self.retry * 2 ** failures, self.interval)
+                failures += 1
+                continue
+
+            failures = 0
+            if self.state_path:
+                _write_state(self.state_path, {'last_checked': time.time()})
+            if latest_match:
+                if self.future.set_running_or_notify_cancel():
+                    self.future.set_result(latest_match)
+                if self.callback is not None:
+                    self.callback(latest_match)
+                return
+            wait = self.interval * (
+                1 + random.uniform(-self.jitter, self.jitter))
 
 
 def freshen_up(**kwargs):
@@ -214,8 +3516,8 @@ def freshen_up(**kwargs):
     Finds, downloads, unpacks, overwrites and restarts your application.
     Essentially an all-in-one for your convenience.
 
-    This function requires 5 arguments to be passed with an additional
-    2 optional.
+    This function requires 5 arguments to be passed with some additional
+    optional ones.
 
     The required arguments are as follows:
 
@@ -237,29 +3539,631 @@ def freshen_up(**kwargs):
       returns ``True`` whenever the second version string is newer than the
       first version string.
     - **unpack** - A function to override the defauly unpacking method that
-      takes two arguments, the archive path and the output folder.
+      takes two arguments, the archive path and the output folder, or
+      ``'patool'`` to always unpack with patool.
+    - **cache** - A :class:`~keepitfresh.PageCache` used to avoid downloading
+      and scanning **base_url** again when it did not change.
+    - **max_pages** - How many pages of a paginated **base_url** to look
+      through, ``None`` for all of them. Defaults to 1. See
+      :func:`~keepitfresh.iter_file_urls`.
+    - **prereleases** - Whether to update to pre-release versions. Defaults
+      to ``True``.
+    - **segments** and **min_segment_size** - Download the archive over
+      several connections, see :func:`~keepitfresh.dl_unpack`.
+    - **staging_dir** - A persistent folder to download the archive to so
+      interrupted downloads can be resumed, see
+      :func:`~keepitfresh.dl_unpack`.
+    - **stream** - Unpack common archive formats while downloading, see
+      :func:`~keepitfresh.dl_unpack`.
+    - **overwrite_mode** - How to replace the application on Unix, see
+      :func:`~keepitfresh.overwrite_restart`. Defaults to ``'copy'``. With
+      ``'swap'`` or ``'incremental'`` the update is unpacked next to
+      **overwrite_item**, on the same filesystem, so it can be renamed into
+      place.
+    - **delta_regex** - A regular expression matching delta artifacts on
+      **base_url**, see :func:`~keepitfresh.get_delta_urls`. When the deltas
+      there chain from **current_version** to the new version they are
+      applied to a hardlinked copy of **overwrite_item** instead of
+      downloading the full archive, which is still used if that fails.
+    - **download_cache** - A :class:`~keepitfresh.DownloadCache` shared by
+      the processes on this host so the archive is only downloaded once,
+      see :func:`~keepitfresh.dl_unpack`.
+    - **checksum_regex** - A regular expression matching checksum files on
+      **base_url**, such as ``r'SHA256SUMS'``, that must list the archive,
+      see :func:`~keepitfresh.get_checksums`. **hash_name** names their
+      algorithm and defaults to ``'sha256'``.
+    - **verify** - A signature verification function, see
+      :func:`~keepitfresh.dl_unpack`.
+    - **tracer** - A function that receives the timings of every phase of
+      the update, such as a :class:`~keepitfresh.TraceCollector`.
+    - **session** - A :class:`~keepitfresh.Session` to reuse connections
+      across every request of the update.
+    - **mirrors** - A list of base urls equivalent to **base_url**. Their
+      pages are fetched in a race, see :func:`~keepitfresh.race_mirrors`,
+      and the first one to answer is used as **base_url**. The archive is
+      then downloaded from the fastest mirror with failover to the others,
+      see :func:`~keepitfresh.dl_unpack`.
+    - **mirror_scores** - A :class:`~keepitfresh.MirrorScores` to rank
+      **mirrors** with, which is updated as they are used.
+    - **keep_fds** and **keep_argv** - Keep listening sockets open and the
+      command line arguments across the restart, see
+      :func:`~keepitfresh.overwrite_restart`.
+    - **version_store** - A :class:`~keepitfresh.VersionStore` to install
+      the new version into and activate, instead of overwriting
+      **overwrite_item**. **entry_point** is then relative to its
+      ``current`` symlink, and **overwrite_item** is only needed for
+      **delta_regex**, pointing to the current version.
+
+    An :class:`~keepitfresh.IntegrityError` is raised, before anything is
+    overwritten, if the archive fails the checks above. Deltas that fail
+    them are skipped in favour of the full archive.
 
     If **versioncmp** is not provided, the standard comparison method from the
     `packaging <https://packaging.pypa.io/en/latest/version/>`_ package is
     used. If **unpack** is not provided, unpacking is handled by
-    `patool <http://wummel.github.io/patool/>`_.
+    :func:`~keepitfresh.unpack_archive`.
+    """
+    from tempfile import TemporaryDirectory
+    overwrite_item = kwargs.get('overwrite_item')
+    entry_point = kwargs.get('entry_point')
+    overwrite_mode = kwargs.get('overwrite_mode', 'copy')
+    tracer = kwargs.get('tracer', None)
+    keep_fds = kwargs.get('keep_fds', None)
+    keep_argv = kwargs.get('keep_argv', False)
+    version_store = kwargs.get('version_store', None)
+
+    latest_match, kwargs = _find_update(kwargs)
+    if not latest_match:
+        raise RuntimeError("No newer version!")
+    tmp_parent = None
+    if version_store is None and overwrite_mode != 'copy':
+        tmp_parent = os.path.dirname(os.path.abspath(overwrite_item))
+    with TemporaryDirectory(prefix='.keepitfresh-', dir=tmp_parent) as tmpdir:
+        initem = _prepare_update(latest_match, tmpdir, **kwargs)
+        if version_store is None:
+            overwrite_restart(initem, overwrite_item, entry_point,
+                              mode=overwrite_mode, tracer=tracer,
+                              keep_fds=keep_fds, keep_argv=keep_argv)
+            return
+        with _Span(tracer, 'install', version=latest_match[1]):
+            version_store.install(initem, latest_match[1])
+            version_store.activate(latest_match[1])
+            version_store.prune()
+    version_store.restart(entry_point, keep_fds, keep_argv)
+
+
+def _find_update(kwargs):
+    """
+    Runs :func:`~keepitfresh.find_update` with the arguments of
+    :func:`~keepitfresh.freshen_up`, racing **base_url** against its
+    **mirrors** if there are any.
+
+    Returns the ``(file_url, file_version)`` pair found, or an empty tuple,
+    along with **kwargs** updated so that **base_url** is the mirror that
+    answered first and **mirrors** are the other ones.
+    """
+    def find(base_url):
+        return find_update(
+            base_url, kwargs.get('regex'), kwargs.get('current_version'),
+            kwargs.get('versioncmp', None), cache=kwargs.get('cache', None),
+            max_pages=kwargs.get('max_pages', 1),
+            prereleases=kwargs.get('prereleases', True),
+            tracer=kwargs.get('tracer', None),
+            session=kwargs.get('session', None))
+
+    mirrors = kwargs.get('mirrors', None)
+    if not mirrors:
+        return find(kwargs.get('base_url')), kwargs
+    base_urls = [kwargs.get('base_url')] + list(mirrors)
+    base_url, latest_match = race_mirrors(
+        base_urls, find, kwargs.get('mirror_scores', None))
+    return latest_match, dict(kwargs, base_url=base_url, mirrors=[
+        url for url in base_urls if url != base_url])
+
+
+def _prepare_update(latest_match, outdir, **kwargs):
+    """
+    Downloads and unpacks the update in the **latest_match** pair to
+    **outdir**, taking the same arguments as :func:`~keepitfresh.freshen_up`,
+    and returns the path of the updated application in it.
     """
     base_url = kwargs.get('base_url')
-    regex = kwargs.get('regex')
     current_version = kwargs.get('current_version')
     overwrite_item = kwargs.get('overwrite_item')
     entry_point = kwargs.get('entry_point')
     versioncmp = kwargs.get('versioncmp', None)
     unpack = kwargs.get('unpack', None)
+    cache = kwargs.get('cache', None)
+    segments = kwargs.get('segments', 1)
+    min_segment_size = kwargs.get('min_segment_size', _MIN_SEGMENT_SIZE)
+    staging_dir = kwargs.get('staging_dir', None)
+    stream = kwargs.get('stream', False)
+    delta_regex = kwargs.get('delta_regex', None)
+    download_cache = kwargs.get('download_cache', None)
+    checksum_regex = kwargs.get('checksum_regex', None)
+    hash_name = kwargs.get('hash_name', 'sha256')
+    verify = kwargs.get('verify', None)
+    tracer = kwargs.get('tracer', None)
+    session = kwargs.get('session', None)
+    mirrors = kwargs.get('mirrors', None)
+    mirror_scores = kwargs.get('mirror_scores', None)
+
+    checksums = checksum = None
+    if checksum_regex is not None:
+        checksums = get_checksums(base_url, checksum_regex, cache, session)
+        checksum = checksums.get(latest_match[0].rsplit('/', 1)[1])
+        if checksum is None:
+            raise IntegrityError("No checksum for {}".format(latest_match[0]))
 
-    file_dict = get_file_urls(base_url, regex)
-    latest_match = get_update_version(file_dict, current_version, versioncmp)
+    if delta_regex is not None and overwrite_item is not None:
+        try:
+            delta_dict = get_delta_urls(base_url, delta_regex, cache, session)
+            delta_urls = find_delta_chain(
+                delta_dict, current_version, latest_match[1], versioncmp,
+                _delta_sizes(delta_dict, current_version, latest_match[1],
+                             versioncmp, session=session))
+            if delta_urls:
+                return _stage_deltas(delta_urls, overwrite_item, outdir,
+                                     checksums=checksums, hash_name=hash_name,
+                                     verify=verify, tracer=tracer,
+                                     session=session)
+        except Exception:  # pylint: disable=broad-except
+            for name in os.listdir(outdir):
+                _remove_item(os.path.join(outdir, name))
+
+    if mirrors:
+        mirrors = _mirror_urls(latest_match[0], base_url, mirrors)
+    dl_unpack(latest_match[0], outdir, unpack, segments=segments,
+              min_segment_size=min_segment_size, staging_dir=staging_dir,
+              stream=stream, download_cache=download_cache,
+              checksum=checksum, hash_name=hash_name, verify=verify,
+              tracer=tracer, session=session, mirrors=mirrors,
+              scores=mirror_scores)
+    if len(os.listdir(outdir)) == 1:
+        return os.path.join(outdir, os.listdir(outdir)[0])
+    return os.path.join(outdir, entry_point)
+
+
+def stage_update(stage_dir, **kwargs):
+    """
+    The first half of :func:`~keepitfresh.freshen_up`: finds the latest
+    version and, if there is one, downloads and unpacks it to the persistent
+    **stage_dir** so that :func:`~keepitfresh.apply_staged` can swap it in
+    the next time the application starts. Nothing is overwritten and the
+    process is not restarted, so this is meant to run in the background,
+    for example from the callback of an :class:`~keepitfresh.UpdateChecker`.
+
+    Takes the same keyword arguments as :func:`~keepitfresh.freshen_up`,
+    except that **overwrite_item** is only needed for **delta_regex** and
+    **overwrite_mode** is passed to :func:`~keepitfresh.apply_staged`
+    instead. Unless a **staging_dir** is given, the archive is downloaded
+    inside **stage_dir** so an interrupted download is resumed by the next
+    call.
+
+    Returns the staged ``(file_url, file_version)`` pair, or an empty tuple
+    if there is no newer version. A version that is already staged is not
+    downloaded again.
+    """
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    latest_match, kwargs = _find_update(kwargs)
     if not latest_match:
-        raise RuntimeError("No newer version!")
-    with TemporaryDirectory() as tmpdir:
-        dl_unpack(latest_match[0], tmpdir, unpack)
-        if len(os.listdir(tmpdir)) == 1:
-            initem = os.path.join(tmpdir, os.listdir(tmpdir)[0])
-        else:
-            initem = os.path.join(tmpdir, entry_point)
-        overwrite_restart(initem, overwrite_item, entry_point)
+        return ()
+
+    ready_path = os.path.join(stage_dir, _STAGED_READY)
+    state = _read_state(ready_path)
+    if state is not None and state.get('url') == latest_match[0]:
+        return latest_match
+
+    kwargs.setdefault('staging_dir', os.path.join(stage_dir, 'download'))
+    update_dir = os.path.join(stage_dir, _STAGED_UPDATE)
+    os.makedirs(stage_dir, exist_ok=True)
+    for path in (ready_path, update_dir):
+        if os.path.lexists(path):
+            _remove_item(path)
+
+    tmpdir = mkdtemp(prefix='.', dir=stage_dir)
+    try:
+        initem = _prepare_update(latest_match, tmpdir, **kwargs)
+        os.replace(tmpdir, update_dir)
+    except BaseException:
+        rmtree(tmpdir, ignore_errors=True)
+        raise
+    _write_state(ready_path, {
+        'url': latest_match[0],
+        'version': latest_match[1],
+        'item': os.path.relpath(initem, tmpdir)})
+    return latest_match
+
+
+def apply_staged(stage_dir, overwrite_item, entry_point, *, mode='swap',
+                 current_version=None, versioncmp=None, tracer=None,
+                 keep_fds=None, keep_argv=False):
+    """
+    The second half of :func:`~keepitfresh.freshen_up`: if an update was
+    staged in **stage_dir** by :func:`~keepitfresh.stage_update`, replaces
+    **overwrite_item** with it and restarts with
+    :func:`~keepitfresh.overwrite_restart`, using **entry_point** and
+    **mode** as it does. Meant to be called first thing on startup::
+
+        >>> apply_staged(stage_dir, overwrite_item, entry_point)
+        >>> # nothing was staged, start as usual
+
+    If **current_version** is passed, a staged update that is not newer
+    (compared as in :func:`~keepitfresh.get_update_version`) is discarded.
+    **tracer**, **keep_fds** and **keep_argv** work as in
+    :func:`~keepitfresh.overwrite_restart`.
+
+    Returns ``False`` if there is nothing to apply, otherwise the process is
+    restarted and it doesn't return. On Unix, the update stays staged until
+    **overwrite_item** was replaced, so it is tried again on the next start
+    if that fails, and is then removed from **stage_dir**.
+    """
+    from platform import system
+    ready_path = os.path.join(stage_dir, _STAGED_READY)
+    update_dir = os.path.join(stage_dir, _STAGED_UPDATE)
+    state = _read_state(ready_path)
+    if state is None:
+        return False
+
+    initem = os.path.join(update_dir, state['item'])
+    if not os.path.lexists(initem) or (
+            current_version is not None and
+            not _is_newer(current_version, state['version'], versioncmp)):
+        os.remove(ready_path)
+        if os.path.lexists(update_dir):
+            _remove_item(update_dir)
+        return False
+
+    if system() == 'Windows':  # pragma: no unix
+        os.remove(ready_path)
+        overwrite_restart(initem, overwrite_item, entry_point, mode=mode,
+                          tracer=tracer, keep_fds=keep_fds,
+                          keep_argv=keep_argv)
+    else:  # pragma: no windows
+        overwrite_item = os.path.abspath(overwrite_item)
+        _overwrite(os.path.abspath(initem), overwrite_item, mode, tracer)
+        os.remove(ready_path)
+        _remove_item(update_dir)
+        _restart(os.path.join(os.path.dirname(overwrite_item), entry_point),
+                 keep_fds, keep_argv)
+    return True
+
+
+class _AsyncResponse:
+    """
+    A minimal HTTP/1.1 response read from asyncio streams, mirroring the
+    parts of :class:`http.client.HTTPResponse` used in this module except
+    that :meth:`read` is a coroutine.
+    """
+    # Mirrors the state of http.client.HTTPResponse.
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, url, status, headers, reader, writer, method='GET', *,
+                 timeout=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self._reader = reader
+        self._writer = writer
+        self._timeout = timeout
+        self._length = None
+        self._chunked = False
+        self._chunk_left = 0
+
+        encoding = headers.get('Transfer-Encoding', '').lower()
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            self._length = 0
+        elif 'chunked' in encoding:
+            self._chunked = True
+        elif headers.get('Content-Length') is not None:
+            self._length = int(headers['Content-Length'])
+
+    def getcode(self):
+        """
+        Returns the HTTP status code.
+        """
+        return self.status
+
+    async def read(self, size=-1):
+        """
+        Reads up to **size** bytes of the body, or all of it if negative.
+        Returns an empty bytes object at the end of the body.
+        """
+        from http.client import IncompleteRead
+        if size < 0:
+            chunks = []
+            while True:
+                chunk = await self.read(_CHUNK_SIZE)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+
+        if self._chunked:
+            return await self._read_chunked(size)
+        if self._length is None:
+            return await self._wait(self._reader.read(size))
+        if not self._length:
+            return b''
+        data = await self._wait(self._reader.read(min(size, self._length)))
+        if not data:
+            raise IncompleteRead(b'', self._length)
+        self._length -= len(data)
+        return data
+
+    async def _read_chunked(self, size):
+        from http.client import IncompleteRead
+        if self._chunk_left is None:
+            return b''
+        if not self._chunk_left:
+            line = await self._wait(self._reader.readline())
+            self._chunk_left = int(line.split(b';', 1)[0], 16)
+            if not self._chunk_left:
+                while (await self._wait(self._reader.readline())).strip():
+                    pass
+                self._chunk_left = None
+                return b''
+
+        data = await self._wait(self._reader.read(min(size,
+                                                      self._chunk_left)))
+        if not data:
+            raise IncompleteRead(b'', self._chunk_left)
+        self._chunk_left -= len(data)
+        if not self._chunk_left:
+            await self._wait(self._reader.readline())
+        return data
+
+    async def _wait(self, awaitable):
+        import asyncio
+        return await asyncio.wait_for(awaitable, self._timeout)
+
+    def close(self):
+        """
+        Closes the connection.
+        """
+        self._writer.close()
+
+
+class _AsyncBlockingResponse:
+    """
+    Wraps a blocking response, such as the ones for ``file://`` urls, so its
+    :meth:`read` runs in the event loop's executor.
+    """
+
+    def __init__(self, response):
+        self.url = response.geturl()
+        self.headers = response.headers
+        self._response = response
+
+    def getcode(self):
+        """
+        Returns the status code, if any.
+        """
+        return self._response.getcode()
+
+    async def read(self, size=-1):
+        """
+        Reads up to **size** bytes without blocking the event loop.
+        """
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._response.read, size)
+
+    def close(self):
+        """
+        Closes the underlying response.
+        """
+        self._response.close()
+
+
+async def _async_urlopen(url, headers=None, method='GET', redirects=10, *,
+                         timeout=None):
+    """
+    The asyncio version of :func:`_urlopen`, following up to **redirects**
+    redirections and waiting up to **timeout** seconds to connect and for
+    each read, raising :exc:`asyncio.TimeoutError` past it.
+
+    Only ``http`` and ``https`` urls are handled natively, others are
+    opened with :mod:`urllib` in the event loop's executor.
+    """
+    import asyncio
+    import ssl
+    from http.client import BadStatusLine, parse_headers
+    from urllib.error import HTTPError
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        loop = asyncio.get_event_loop()
+        response = await loop.run_in_executor(None, _urlopen, url, headers,
+                                              method)
+        return _AsyncBlockingResponse(response)
+
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    context = ssl.create_default_context() if secure else None
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(
+        parts.hostname, port, ssl=context), timeout)
+
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+    request_headers = OrderedDict([
+        ('Host', parts.netloc.rpartition('@')[2]),
+        ('User-Agent', 'keepitfresh'),
+        ('Accept-Encoding', 'identity'),
+        ('Connection', 'close')])
+    request_headers.update(headers or {})
+    request = ['{} {} HTTP/1.1'.format(method, target)]
+    request.extend('{}: {}'.format(name, value)
+                   for name, value in request_headers.items())
+    writer.write(('\r\n'.join(request) + '\r\n\r\n').encode('latin-1'))
+
+    try:
+        status_line = (await asyncio.wait_for(
+            reader.readline(), timeout)).decode('latin-1').split()
+        if len(status_line) < 2 or not status_line[0].startswith('HTTP/'):
+            raise BadStatusLine(' '.join(status_line))
+        status = int(status_line[1])
+        reason = ' '.join(status_line[2:])
+
+        header_lines = []
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        response_headers = parse_headers(BytesIO(b''.join(header_lines)))
+    except BaseException:
+        writer.close()
+        raise
+
+    response = _AsyncResponse(url, status, response_headers, reader, writer,
+                              method, timeout=timeout)
+
+    location = response_headers.get('Location')
+    if status in (301, 302, 303, 307, 308) and location and redirects > 0:
+        response.close()
+        if status == 303:
+            method = 'GET'
+        return await _async_urlopen(urljoin(url, location), headers, method,
+                                    redirects - 1, timeout=timeout)
+    if status >= 400:
+        response.close()
+        raise HTTPError(url, status, reason, response_headers, None)
+    return response
+
+
+async def _get_page_async(base_url, regexes, cache=None, *, timeout=None):
+    """
+    The asyncio version of :func:`_get_page`.
+
+    Reading and writing **cache** and scanning the page run in the event
+    loop's executor.
+    """
+    import asyncio
+    loop = asyncio.get_event_loop()
+    scan = await loop.run_in_executor(None, _PageScan, base_url, regexes,
+                                      cache)
+    if scan.fresh:
+        return scan.cached()
+    web = await _async_urlopen(base_url, scan.headers, timeout=timeout)
+    try:
+        if scan.conditional and web.getcode() == 304:
+            return await loop.run_in_executor(None, scan.not_modified)
+        scan.start(web.headers)
+        while True:
+            chunk = await web.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            await loop.run_in_executor(None, scan.feed, chunk)
+    finally:
+        web.close()
+    return await loop.run_in_executor(None, scan.finish)
+
+
+async def get_file_urls_async(base_url, regex, cache=None, *, timeout=30):
+    """
+    The asyncio version of :func:`~keepitfresh.get_file_urls`.
+
+    **timeout** is the number of seconds to wait to connect and for each
+    read, as in :class:`~keepitfresh.Session`, after which
+    :exc:`asyncio.TimeoutError` is raised.
+    """
+    return (await _get_page_async(base_url, (regex,), cache,
+                                  timeout=timeout))[0][0]
+
+
+async def find_update_async(base_url, regex, current_version, versioncmp=None,
+                            *, cache=None, max_pages=1, prereleases=True,
+                            timeout=30):
+    """
+    The asyncio version of :func:`~keepitfresh.find_update`, with the
+    **timeout** of :func:`~keepitfresh.get_file_urls_async`.
+    """
+    file_urls = []
+    url = base_url
+    visited = set()
+    while url is not None and url not in visited:
+        if max_pages is not None and len(visited) >= max_pages:
+            break
+        visited.add(url)
+        file_dicts, url = await _get_page_async(url, (regex,), cache,
+                                                timeout=timeout)
+        file_urls.extend(file_dicts[0].items())
+        if _has_passed(file_dicts[0], current_version, versioncmp):
+            break
+    return get_update_version(file_urls, current_version, versioncmp,
+                              prereleases)
+
+
+async def is_fresh_async(base_url, regex, current_version, versioncmp=None,
+                         *, cache=None, max_pages=1, prereleases=True,
+                         timeout=30):
+    """
+    The asyncio version of :func:`~keepitfresh.is_fresh`, with the
+    **timeout** of :func:`~keepitfresh.get_file_urls_async`.
+    """
+    url = base_url
+    visited = set()
+    while url is not None and url not in visited:
+        if max_pages is not None and len(visited) >= max_pages:
+            break
+        visited.add(url)
+        file_dicts, url = await _get_page_async(url, (regex,), cache,
+                                                timeout=timeout)
+        result = _check_page(file_dicts[0], current_version, versioncmp,
+                             prereleases)
+        if result is not None:
+            return result
+    return True
+
+
+def _write_chunk(out_file, chunk, hasher=None):
+    """
+    Writes **chunk** to **out_file**, feeding it to the :mod:`hashlib`
+    object **hasher** if passed.
+    """
+    if hasher is not None:
+        hasher.update(chunk)
+    out_file.write(chunk)
+
+
+async def dl_unpack_async(url, outdir, unpack=None, *, checksum=None,
+                          hash_name='sha256', verify=None, timeout=30):
+    """
+    The asyncio version of :func:`~keepitfresh.dl_unpack`, with the
+    **timeout** of :func:`~keepitfresh.get_file_urls_async`.
+
+    The download streams through the event loop, while writing it to disk,
+    unpacking it and cleaning up run in the loop's executor.
+    """
+    import asyncio
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    fname = url.rsplit('/', 1)[1]
+    hasher = (hashlib.new(hash_name)
+              if checksum is not None or verify is not None else None)
+    loop = asyncio.get_event_loop()
+    tmpdir = await loop.run_in_executor(None, mkdtemp)
+    try:
+        file_path = os.path.join(tmpdir, fname)
+        response = await _async_urlopen(url, timeout=timeout)
+        try:
+            out_file = await loop.run_in_executor(None, open, file_path, 'wb')
+            try:
+                while True:
+                    chunk = await response.read(_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    await loop.run_in_executor(None, _write_chunk, out_file,
+                                               chunk, hasher)
+            finally:
+                await loop.run_in_executor(None, out_file.close)
+        finally:
+            response.close()
+
+        _check_integrity(url, hasher, checksum, verify)
+
+        await loop.run_in_executor(None, _unpack, file_path, outdir, unpack)
+    finally:
+        await loop.run_in_executor(None, partial(rmtree, tmpdir,
+                                                 ignore_errors=True))